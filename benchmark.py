@@ -0,0 +1,334 @@
+#! /usr/bin/python2
+
+"""Benchmarks the solver on a fixed corpus of deals and compares the results
+with a stored baseline to find regressions.
+"""
+
+import argparse
+import json
+import logging
+from multiprocessing import Pipe, Pool, Process
+import random
+import sys
+
+import freecell
+from freecell import (
+    DECK_SIZE, NUM_PILES, SUITS, FreeCellProblem, FreeCellState,
+    solve
+)
+from search import SearchResult, SearchStats
+
+RANK_NAMES = 'A23456789TJQK'
+
+# Each deal is (swaps, seed): see make_deal. More swaps make harder deals.
+DEALS = (
+    (5, 1), (5, 2), (10, 1), (10, 2), (20, 1), (20, 2), (50, 1), (100, 2)
+)
+
+# Maps a configuration name to keyword arguments for solve and the
+# heuristic.
+CONFIGS = {
+    'astar-buried': {'algorithm': 'astar', 'heuristic': 'buried'},
+    'astar-pressure-w2': {
+        'algorithm': 'astar', 'heuristic': 'pressure', 'weight': 2
+    },
+    'idastar-next_card-w2': {
+        'algorithm': 'idastar', 'heuristic': 'next_card', 'weight': 2
+    },
+    'beam-pressure': {
+        'algorithm': 'beam', 'heuristic': 'pressure', 'width': 200
+    },
+    'dfs': {'algorithm': 'dfs', 'heuristic': 'foundations'},
+    'external-buried': {'algorithm': 'external', 'heuristic': 'buried'},
+}
+
+# The configuration for the hdastar scaling runs (see run_scaling), which
+# is run with each number of workers
+SCALING_CONFIG = {'algorithm': 'hdastar', 'heuristic': 'buried'}
+
+MAX_NODES = 10000
+
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+
+
+def make_deal(swaps, seed):
+    """Return a deal made by swapping this many random pairs of cards
+    (from random.Random(seed)) in an easy deal, where each suit is in order
+    with its ace on top.
+    """
+    deck = [
+        rank + suit for suit in SUITS for rank in reversed(RANK_NAMES)
+    ]
+    rand = random.Random(seed)
+    for _ in xrange(swaps):
+        first = rand.randrange(DECK_SIZE)
+        second = rand.randrange(DECK_SIZE)
+        deck[first], deck[second] = deck[second], deck[first]
+    rows = [[] for _ in xrange(NUM_PILES)]
+    for index, card in enumerate(deck):
+        rows[index * NUM_PILES // DECK_SIZE].append(card)
+    return FreeCellState.from_rows(rows)
+
+
+def deal_name(swaps, seed):
+    """Return the name of a deal from DEALS."""
+    return 'swaps%s-seed%s' % (swaps, seed)
+
+
+def _run(job):
+    """Run a benchmark in a worker process and return its record. job is a
+    (deal, configuration name) pair, or (deal, configuration name,
+    configuration) for a configuration that isn't in CONFIGS.
+    """
+    (swaps, seed), config_name = job[:2]
+    options = dict(job[2] if len(job) > 2 else CONFIGS[config_name])
+    heuristic = options.pop('heuristic')
+    stats = SearchStats()
+    result = SearchResult.of(
+        solve, FreeCellProblem(make_deal(swaps, seed), heuristic),
+        max_nodes=MAX_NODES, stats=stats, **options
+    )
+    return {
+        'deal': deal_name(swaps, seed),
+        'config': config_name,
+        'status': result.status,
+        'expanded': stats.expanded,
+        'generated': stats.generated,
+        'seconds': round(result.seconds, 3),
+        'peak_memory': stats.peak_memory,
+        'solution_length': stats.solution_length,
+        'solution_cost': (
+            freecell._moves_cost(result.moves)
+            if result.status == SearchResult.SOLVED else None
+        ),
+        'numpy': freecell.numpy is not None,
+    }
+
+
+def run(config_names=None):
+    """Run every deal in DEALS with these configurations (all of CONFIGS by
+    default) and return the list of records.
+
+    The runs are one at a time so they don't compete for the CPU, each in a
+    fresh process so the peak memory is its own.
+    """
+    if config_names is None:
+        config_names = sorted(CONFIGS)
+    jobs = [(deal, name) for deal in DEALS for name in config_names]
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        rtn = []
+        for record in pool.imap(_run, jobs):
+            logging.info('%(deal)s %(config)s: %(status)s' % record)
+            rtn.append(record)
+        pool.close()
+        return rtn
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _run_child(connection, job):
+    """Send the record of _run(job) through this connection."""
+    connection.send(_run(job))
+    connection.close()
+
+
+def run_scaling(worker_counts):
+    """Run every deal in DEALS with SCALING_CONFIG and each of these numbers
+    of workers, and return the list of records. The configuration of a
+    record is named 'hdastar-buried-N' for N workers.
+
+    hdastar starts its own processes, which a Pool's daemon processes
+    can't, so each run has a fresh process of its own.
+    """
+    rtn = []
+    for deal in DEALS:
+        for workers in worker_counts:
+            job = (
+                deal, 'hdastar-%s-%s' % (SCALING_CONFIG['heuristic'], workers),
+                dict(SCALING_CONFIG, workers=workers)
+            )
+            receiver, sender = Pipe(False)
+            process = Process(target=_run_child, args=(sender, job))
+            process.start()
+            sender.close()
+            try:
+                record = receiver.recv()
+            finally:
+                process.join()
+            logging.info('%(deal)s %(config)s: %(status)s' % record)
+            rtn.append(record)
+    return rtn
+
+
+def format_scaling(records, worker_counts):
+    """Return the speedup of each deal's run_scaling records over its run
+    with the first number of workers, as a text table.
+    """
+    lines = ['%-16s' % 'deal' + ''.join(
+        '%12s' % ('%s workers' % workers) for workers in worker_counts
+    )]
+    for index in xrange(0, len(records), len(worker_counts)):
+        runs = records[index:index + len(worker_counts)]
+        first = runs[0]['seconds']
+        lines.append('%-16s' % runs[0]['deal'] + ''.join(
+            '%12s' % ('%.2fx' % (first / record['seconds'])
+            if record['seconds'] else '-')
+            for record in runs
+        ))
+    return '\n'.join(lines)
+
+
+def _key(record):
+    return '%s %s' % (record['deal'], record['config'])
+
+
+def compare(
+    records, baseline, node_tolerance=0.1, time_tolerance=None,
+    memory_tolerance=0.25
+):
+    """Return the list of regressions of these records from the baseline
+    (a list of records), as strings.
+
+    A run regresses if it no longer solves its deal, finds a costlier
+    solution (by the cards its moves move, not the number of moves), or
+    expands, takes or uses more than the tolerance (a fraction) more nodes,
+    seconds or memory. Times are only compared if time_tolerance isn't
+    None, since the baseline's were taken on one machine, and times under a
+    tenth of a second are too noisy to compare. Memory isn't compared
+    between a run that imported numpy for its heuristic and one that didn't
+    (records without "numpy" didn't), since numpy alone takes about 9 MB.
+    """
+    old_records = dict((_key(record), record) for record in baseline)
+    rtn = []
+    for record in records:
+        old = old_records.get(_key(record))
+        if old is None:
+            continue
+        def regress(msg):
+            rtn.append('%s: %s' % (_key(record), msg))
+        if old['status'] == SearchResult.SOLVED:
+            if record['status'] != SearchResult.SOLVED:
+                regress('%s (was solved)' % record['status'])
+                continue
+            if record['solution_cost'] > old['solution_cost']:
+                regress('costs %s (was %s)' % (
+                    record['solution_cost'], old['solution_cost']
+                ))
+        if record['expanded'] > old['expanded'] * (1 + node_tolerance):
+            regress('%s nodes (was %s)' % (record['expanded'], old['expanded']))
+        if time_tolerance is not None and \
+         record['seconds'] > max(old['seconds'], 0.1) * (1 + time_tolerance):
+            regress('%s seconds (was %s)' % (record['seconds'], old['seconds']))
+        if old['peak_memory'] is not None and \
+         old.get('numpy', False) == record['numpy'] and \
+         record['peak_memory'] > old['peak_memory'] * (1 + memory_tolerance):
+            regress('%.1f MB (was %.1f MB)' % (
+                record['peak_memory'], old['peak_memory']
+            ))
+    return rtn
+
+
+def format_table(records, baseline=()):
+    """Return the records as a text table, with the change from the baseline
+    in parentheses.
+    """
+    old_records = dict((_key(record), record) for record in baseline)
+    lines = ['%-16s %-22s %-16s %15s %14s %11s %10s %10s' % (
+        'deal', 'config', 'status', 'nodes', 'seconds', 'MB', 'moves', 'cost'
+    )]
+    for record in records:
+        old = old_records.get(_key(record))
+        def column(name, fmt):
+            value = record[name]
+            if value is None:
+                return '-'
+            rtn = fmt % value
+            if old is not None and old[name] is not None and old[name]:
+                rtn += ' (%+.0f%%)' % (100.0 * (value - old[name]) / old[name])
+            return rtn
+        lines.append('%-16s %-22s %-16s %15s %14s %11s %10s %10s' % (
+            record['deal'], record['config'], record['status'],
+            column('expanded', '%d'), column('seconds', '%.2f'),
+            column('peak_memory', '%.0f'), column('solution_length', '%d'),
+            column('solution_cost', '%d')
+        ))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Run the benchmark corpus and compare it with the baseline. Exits '
+        'with status 1 if anything regressed.'
+    ))
+    parser.add_argument(
+        '--baseline', default=DEFAULT_BASELINE,
+        help='The JSON file with the baseline records.'
+    )
+    parser.add_argument(
+        '--save', action='store_true',
+        help='Save the results as the new baseline instead of comparing.'
+    )
+    parser.add_argument(
+        '--config', action='append', choices=sorted(CONFIGS),
+        help='Only run this configuration. May be given several times.'
+    )
+    parser.add_argument(
+        '--workers',
+        help=(
+            'Instead of the benchmark, run hdastar with each of these '
+            'comma-separated numbers of workers (e.g. 1,2,4) and show the '
+            'speedups.'
+        )
+    )
+    parser.add_argument(
+        '--node-tolerance', type=float, default=0.1,
+        help='The fraction more nodes that counts as a regression.'
+    )
+    parser.add_argument(
+        '--time-tolerance', type=float,
+        help=(
+            'The fraction more time that counts as a regression (e.g. 0.5). '
+            'Times are not compared unless this is given, since they depend '
+            'on the machine the baseline was saved on.'
+        )
+    )
+    parser.add_argument(
+        '--memory-tolerance', type=float, default=0.25,
+        help='The fraction more memory that counts as a regression.'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.workers:
+        worker_counts = [int(workers) for workers in args.workers.split(',')]
+        records = run_scaling(worker_counts)
+        print format_table(records)
+        print
+        print format_scaling(records, worker_counts)
+        return
+
+    records = run(args.config)
+    if args.save:
+        with open(args.baseline, 'w') as file_obj:
+            json.dump(records, file_obj, indent=1, sort_keys=True)
+        print format_table(records)
+        return
+
+    with open(args.baseline) as file_obj:
+        baseline = json.load(file_obj)
+    print format_table(records, baseline)
+    regressions = compare(
+        records, baseline, args.node_tolerance, args.time_tolerance,
+        args.memory_tolerance
+    )
+    if regressions:
+        print '\nRegressions:'
+        for regression in regressions:
+            print regression
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
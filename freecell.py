@@ -2,13 +2,30 @@
 
 """A Freecell problem"""
 
-from copy import deepcopy, copy
 import csv
 import argparse
-from itertools import permutations
+import cProfile
+from itertools import chain, count, islice
+import json
 import logging
-
-from search import Problem, astar
+import multiprocessing
+import os
+import pstats
+import Queue
+import random
+import re
+import signal
+import SocketServer
+import sqlite3
+import sys
+import threading
+from time import time
+
+import patterndb
+from search import (
+    Problem, SearchResult, SearchStats, _rss_megabytes, astar, beam, dfs,
+    external_astar, hdastar, idastar, log_stats
+)
 
 SUITS = ('H', 'D', 'C', 'S')
 MAX_RANK = 13
@@ -17,493 +34,1080 @@ NUM_PILES = 8
 NUM_FREECELLS = 4
 
 
-class Tableau(object):
-    def __init__(self, filename):
-        """Initialize the tableau from this csv."""
-        logging.info('Reading in the csv')
-        self._tableau = {}
-        made_cards = set()
-        with open(filename) as file_obj:
-            for row in csv.reader(file_obj):
-                pile = []
-                for card_str in row:
-                    card = Card.get(card_str)
-                    if card in made_cards:
-                        raise Exception('Duplicate card: %s' % card)
-                    pile.append(card)
-                    made_cards.add(card)
-                self._tableau[pile[-1]] = tuple(pile)
-
-        if len(self._tableau) != NUM_PILES:
-            raise Exception(
-                'Incorrect number of piles: %s' % len(self._tableau)
+# The code of a card is chr(suit * MAX_RANK + rank - 1).
+def _make_card_tables():
+    """Return the (ranks, suits, names, parents, suit_codes) tables.
+
+    The first four are dicts mapping a card code to its rank, its suit, its
+    two-character string, and a string of the codes of the two cards it can
+    go on top of. suit_codes[suit][rank - 1] is the code of the card with
+    this rank and suit, so suit_codes[suit][rank] is the card that goes on
+    a foundation that is up to rank.
+    """
+    rank_names = 'A23456789TJQK'
+    ranks = {}
+    suits = {}
+    names = {}
+    parents = {}
+    suit_codes = []
+    for suit in xrange(len(SUITS)):
+        suit_codes.append(''.join(
+            chr(suit * MAX_RANK + rank - 1) for rank in xrange(1, MAX_RANK+1)
+        ))
+    for suit, codes in enumerate(suit_codes):
+        for rank, code in enumerate(codes, start=1):
+            ranks[code] = rank
+            suits[code] = suit
+            names[code] = rank_names[rank - 1] + SUITS[suit]
+            parents[code] = ''.join(
+                other_codes[rank]
+                for other_suit, other_codes in enumerate(suit_codes)
+                if rank < MAX_RANK and (suit < 2) != (other_suit < 2)
             )
+    return ranks, suits, names, parents, suit_codes
+
+_RANK, _SUIT, _NAME, _PARENTS, _SUIT_CODES = _make_card_tables()
+_CODE = dict((name, code) for code, name in _NAME.iteritems())
+
+# The numbered deals shuffle a deck ordered by rank, then by suit in this
+# order. _DEAL_DECK[n] is the code of the nth card of that deck.
+_DEAL_DECK = tuple(
+    _SUIT_CODES[SUITS.index(suit)][rank]
+    for rank in xrange(MAX_RANK)
+    for suit in ('C', 'D', 'H', 'S')
+)
+MAX_DEAL = 0x7fffffff
+
+
+# Each card contributes a Zobrist key for its location: the code of the card
+# under it, _PILE_BOTTOM or _FREECELL. Cards on the foundations contribute
+# nothing since they're implied by the rest. The keys don't depend on the
+# order of the piles or the free cells.
+_PILE_BOTTOM = chr(DECK_SIZE)
+_FREECELL = chr(DECK_SIZE + 1)
+# _ZOBRIST[code][location] is the key for the card with this code at this
+# location.
+_zobrist_random = random.Random(0)
+_ZOBRIST = dict(
+    (chr(code), dict(
+        (chr(location), int(_zobrist_random.getrandbits(63)))
+        for location in xrange(DECK_SIZE + 2)
+    ))
+    for code in xrange(DECK_SIZE)
+)
+del _zobrist_random
+
+
+def _top_location(pile):
+    """Return the location of the top card of this non-empty pile."""
+    return pile[-2] if len(pile) > 1 else _PILE_BOTTOM
+
+
+def _full_hash(piles, freecells):
+    """Return the Zobrist hash of these piles and free cells."""
+    rtn = 0
+    for pile in piles:
+        location = _PILE_BOTTOM
+        for code in pile:
+            rtn ^= _ZOBRIST[code][location]
+            location = code
+    for code in freecells:
+        rtn ^= _ZOBRIST[code][_FREECELL]
+    return rtn
+
+
+# Separates the free cells and piles in a canonical key. It isn't a card code.
+_KEY_SEPARATOR = chr(255)
+
+
+def _make_suit_swaps():
+    """Return the str.translate tables for the suit swaps that keep the
+    colors of the cards: none, H and D, C and S, and both. Each swap undoes
+    itself.
+    """
+    rtn = []
+    for swap_red in False, True:
+        for swap_black in False, True:
+            table = [chr(index) for index in xrange(256)]
+            for suit, codes in enumerate(_SUIT_CODES):
+                swap = swap_red if suit < 2 else swap_black
+                # SUITS pairs up H with D and C with S.
+                other_codes = _SUIT_CODES[suit ^ 1 if swap else suit]
+                for code, other_code in zip(codes, other_codes):
+                    table[ord(code)] = other_code
+            rtn.append(''.join(table))
+    return tuple(rtn)
+
+_SUIT_SWAPS = _make_suit_swaps()
+
+
+def _run_length(pile):
+    """Return the number of cards at the top of this non-empty pile that are
+    in sequence (each goes on top of the one under it).
+    """
+    length = 1
+    while length < len(pile) and pile[-length-1] in _PARENTS[pile[-length]]:
+        length += 1
+    return length
+
+
+def _supermove_capacity(free, num_empty):
+    """Return the most cards that can move together with this many empty
+    free cells and empty piles (not counting the destination).
+    """
+    return (free + 1) << num_empty
+
+
+def _with_pile(piles, index, pile):
+    """Return a copy of the piles tuple with the pile at index replaced."""
+    return piles[:index] + (pile,) + piles[index+1:]
+
+
+# Kinds of moves. A move is a (kind, card code, destination) tuple. The
+# destination is the code of the card the moved card goes on top of for
+# ON_CARD and SEQUENCE_ON_CARD moves and None otherwise. An AUTO_FOUNDATION
+# move puts a string of card codes on their foundations one after another.
+# The SEQUENCE moves move a string of card codes (bottom to top) from the top
+# of a pile together.
+TABLEAU_TO_FOUNDATION = 'tableau_to_foundation'
+FREE_TO_FOUNDATION = 'free_to_foundation'
+AUTO_FOUNDATION = 'auto_foundation'
+ON_CARD = 'on_card'
+NEW_PILE = 'new_pile'
+SEQUENCE_ON_CARD = 'sequence_on_card'
+SEQUENCE_NEW_PILE = 'sequence_new_pile'
+TO_FREECELL = 'to_freecell'
+
+_moves = {}
+
+
+def _move(kind, card, destination=None):
+    """Return the move tuple for this move. Equal moves are the same
+    object, so the search tree only stores a reference per node.
+    """
+    move = (kind, card, destination)
+    return _moves.setdefault(move, move)
+
+
+# Moves are encoded in a string as the character for their kind, their
+# cards, then _ONTO and the destination if there is one. None of these
+# characters are card codes, so the string can be translated by a table from
+# _SUIT_SWAPS.
+_MOVE_KINDS = (
+    TABLEAU_TO_FOUNDATION, FREE_TO_FOUNDATION, AUTO_FOUNDATION, ON_CARD,
+    NEW_PILE, SEQUENCE_ON_CARD, SEQUENCE_NEW_PILE, TO_FREECELL
+)
+_KIND_BASE = 200
+_ONTO = chr(254)
+_ENCODED_MOVE = re.compile(
+    '([\\x%x-\\x%x])([\\x00-\\x%x]+)(?:%s([\\x00-\\x%x]))?' % (
+        _KIND_BASE, _KIND_BASE + len(_MOVE_KINDS) - 1, DECK_SIZE - 1,
+        _ONTO, DECK_SIZE - 1
+    )
+)
+
+
+_KIND_CHARS = dict(
+    (kind, chr(_KIND_BASE + index)) for index, kind in enumerate(_MOVE_KINDS)
+)
+_CHAR_KINDS = dict((char, kind) for kind, char in _KIND_CHARS.iteritems())
+
+
+def _encode_moves(moves):
+    """Return the string encoding these moves."""
+    return ''.join(
+        _KIND_CHARS[kind] + card +
+        ('' if destination is None else _ONTO + destination)
+        for kind, card, destination in moves
+    )
+
+
+def _decode_moves(encoded):
+    """Return the moves encoded in this string."""
+    kinds = _CHAR_KINDS
+    return [
+        (kinds[kind], card, destination or None)
+        for kind, card, destination in _ENCODED_MOVE.findall(encoded)
+    ]
+
+
+def _cards_str(codes):
+    """Return the text for this string of card codes (e.g. "8C, 7H and 6S").
+    """
+    names = [_NAME[code] for code in codes]
+    return '%s and %s' % (', '.join(names[:-1]), names[-1])
+
+
+def move_to_str(move):
+    """Return the text describing this move."""
+    kind, card, destination = move
+    if kind == AUTO_FOUNDATION:
+        return '\n'.join(
+            'Put %s in its foundation.' % _NAME[code] for code in card
+        )
+    if kind == TABLEAU_TO_FOUNDATION:
+        return 'Move %s to its foundation.' % _NAME[card]
+    if kind == FREE_TO_FOUNDATION:
+        return 'Put %s in its foundation.' % _NAME[card]
+    if kind == ON_CARD:
+        return 'Put %s on top of %s.' % (_NAME[card], _NAME[destination])
+    if kind == NEW_PILE:
+        return 'Put %s in a new pile.' % _NAME[card]
+    if kind == SEQUENCE_ON_CARD:
+        return 'Move %s on top of %s.' % (
+            _cards_str(card), _NAME[destination]
+        )
+    if kind == SEQUENCE_NEW_PILE:
+        return 'Move %s to a new pile.' % _cards_str(card)
+    if kind == TO_FREECELL:
+        return 'Put %s in a free cell.' % _NAME[card]
+    raise Exception('What move is this?: %s' % (move,))
+
+
+def move_to_dict(move):
+    """Return a JSON-serializable dict describing this move."""
+    kind, card, destination = move
+    if kind in (AUTO_FOUNDATION, SEQUENCE_ON_CARD, SEQUENCE_NEW_PILE):
+        rtn = {'move': kind, 'cards': [_NAME[code] for code in card]}
+    else:
+        rtn = {'move': kind, 'card': _NAME[card]}
+    if destination is not None:
+        rtn['onto'] = _NAME[destination]
+    return rtn
+
+
+def format_solution(moves, output_format='text'):
+    """Return the solution (a list of moves or None) as a string.
+    output_format is 'text' (one move per line) or 'json'.
+    """
+    if output_format == 'json':
+        if moves is None:
+            return json.dumps(None)
+        return json.dumps([move_to_dict(move) for move in moves])
+    if moves is None:
+        return 'No solution.'
+    return '\n'.join(move_to_str(move) for move in moves)
+
+
+# The foundations are packed into an integer with this many bits per suit.
+# The value for SUITS[n] is the maximum rank on its foundation (0 if empty).
+_FOUNDATION_BITS = 4
+_FOUNDATION_MASK = (1 << _FOUNDATION_BITS) - 1
+_GOAL_FOUNDATIONS = sum(
+    MAX_RANK << (_FOUNDATION_BITS * suit) for suit in xrange(len(SUITS))
+)
+
+
+# _FOUNDATION_UNIT[suit] is the amount to add to the foundations to put the
+# next card on this suit's foundation.
+_FOUNDATION_UNIT = tuple(
+    1 << (_FOUNDATION_BITS * suit) for suit in xrange(len(SUITS))
+)
+
+
+def _foundation_ranks(foundations):
+    """Return the list of the maximum ranks on each foundation."""
+    return [
+        (foundations >> (_FOUNDATION_BITS * suit)) & _FOUNDATION_MASK
+        for suit in xrange(len(SUITS))
+    ]
 
-        unmade_cards = Card.missing_cards()
-        if unmade_cards:
-            msg = 'These cards were not in the csv:\n'
-            for card in unmade_cards:
-                msg += '%s\n' % card
-            raise Exception(msg)
-
-        logging.info('Done reading the csv')
-
-    def __deepcopy__(self, _):
-        rtn = copy(self)
-        rtn._tableau = dict(rtn._tableau)
-        return rtn
-
-    def __contains__(self, item):
-        """Item should be a card."""
-        return item in self._tableau
 
-    def piles(self):
-        """Return the set of piles (tuples)."""
-        return set(self._tableau.itervalues())
+def _plays_back(ranks, suit):
+    """Return whether the top card of this suit's foundation would be
+    played straight back if it came off. ranks is the list from
+    _foundation_ranks. Then the only move from the state it leads to is the
+    AUTO_FOUNDATION move back to this state, so there's no point to it.
+    """
+    rank = ranks[suit] - 1
+    return rank - min(min(ranks), rank) <= 1
 
-    def internal_moves(self):
-        """Return a list of (tableau, move) pairs of moves within the tableau.
-        """
-        rtn = []
 
-        # Put cards in a new pile
-        if len(self._tableau) < NUM_PILES:
-            for card, pile in self._tableau.iteritems():
-                if len(pile) > 1:
-                    tableau = deepcopy(self)
-                    tableau._remove(card)
-                    tableau._put_in_new_pile(card)
-                    rtn.append((tableau, 'Put %s in a new pile.' % card))
-
-        # Put cards on top of other cards
-        for on_top, on_bottom in permutations(self._tableau, 2):
-            if on_top.goes_on_top_of(on_bottom):
-                tableau = deepcopy(self)
-                tableau._remove(on_top)
-                tableau._put_on_pile(on_bottom, on_top)
-                rtn.append(
-                    (tableau, 'Put %s on top of %s.' % (on_top, on_bottom))
-                )
+# The ways to split the suits into two pairs, and the pairs
+_SUIT_PAIRINGS = (((0, 1), (2, 3)), ((0, 2), (1, 3)), ((0, 3), (1, 2)))
+_SUIT_PAIRS = tuple(pair for pairing in _SUIT_PAIRINGS for pair in pairing)
 
-        return rtn
 
-    def _put_in_new_pile(self, card):
-        """Put the card (Card, string, or tuple) in a new pile."""
-        card = Card.get(card)
-        assert card not in self._tableau
-        assert len(self._tableau) < NUM_PILES
-        self._tableau[card] = card,
-
-    def _moves_in_new_pile(self, card):
-        """Return a list of (Tableau, move) pairs (a list of length 0 or 1) 
-        resulting in placing this card (Card, string, or tuple) in a new pile.
-        """
-        card = Card.get(card)
-        assert card not in self._tableau
-        if len(self._tableau) == NUM_PILES:
-            return []
-        tableau = deepcopy(self)
-        tableau._put_in_new_pile(card)
-        return [(tableau, 'Put %s in a new pile.' % card)]
-
-    def _put_on_pile(self, old_top_card, new_top_card):
-        """Put the new_top_card on top of the old_top_card. Both cards can
-        be Cards, strings, or tuples.
-        """
-        old_top_card = Card.get(old_top_card)
-        new_top_card = Card.get(new_top_card)
-        assert old_top_card in self._tableau
-        assert new_top_card.goes_on_top_of(old_top_card)
-        assert new_top_card not in self._tableau
-        self._tableau[new_top_card] = self._tableau[old_top_card] + (new_top_card,)
-        del self._tableau[old_top_card]
-
-    def _moves_on_a_pile(self, card):
-        """Return a list of (Tableau, move) pairs resulting in placing this
-        card (Card, string, or tuple) on a pile.
+class FreeCellState(object):
+    """An immutable FreeCell position.
+
+    The tableau is a tuple of NUM_PILES strings, each listing the card codes
+    of a pile from the bottom to the top ('' is an empty pile). A successor
+    shares every pile it doesn't change with its parent. The free cells are
+    a sorted string of card codes, and the foundations are a packed integer.
+    Each move updates the Zobrist hash of its parent instead of rehashing.
+
+    Two states are equal if they have the same free cells and the same
+    multiset of piles. The order of the piles doesn't matter.
+
+    A state also remembers the card the move to it moved, so it doesn't
+    generate moves that just move that card again (see _pruned). That
+    isn't part of the state: equal states may remember different cards.
+    """
+
+    __slots__ = (
+        '_piles', '_freecells', '_foundations', '_hash', '_key', '_canonical',
+        '_moved'
+    )
+
+    def __init__(
+        self, piles, freecells='', foundations=0, hash_value=None, moved=None
+    ):
+        """Return a new state. piles is a tuple of NUM_PILES strings of card
+        codes, freecells is a sorted string of card codes, and foundations
+        is the packed foundations integer. hash_value is the Zobrist hash,
+        computed from scratch if None. moved is the code of the card the
+        move to this state moved (the bottom one of a sequence), or None.
         """
-        rtn = []
-        card = Card.get(card)
-        for top_card in self._tableau:
-            if card.goes_on_top_of(top_card):
-                tableau = deepcopy(self)
-                tableau._put_on_pile(top_card, card)
-                rtn.append((tableau, 'Put %s on top of %s.' % (card, top_card)))
-
-        return rtn
-
-    def place(self, card):
-        """Return (tableau, move) pairs resulting from placing this card
-        in the tableau. card can be a string, tuple, or Card.
-        """
-        return self._moves_on_a_pile(card) + self._moves_in_new_pile(card)
-
-    def top_cards(self):
-        """Return the set of cards that are on the top of each pile."""
-        return set(self._tableau)
-
-    def _remove(self, card):
-        """Remove the card (Card, (rank, suit) tuple, or string from this
-        tableau.
-        """
-        card = Card.get(card)
-        new_pile = self._tableau[card][:-1]
-        del self._tableau[card]
-        if new_pile:
-            self._tableau[new_pile[-1]] = new_pile
-
-    def remove(self, card):
-        """Return a new Tableau with this card removed. The card should be from
-        the top of a pile. card may be a Card, (rank, suit) tuple, or
-        string.
-        """
-        new_tableau = deepcopy(self)
-        new_tableau._remove(card)
-        return new_tableau
-
-    def _place_on_top(self, new_top_card, old_top_card):
-        """Place new_top_card on top of old_top_card. The cards can be
-        Cards, tuples, or strings.
-        """
-        new_top_card = Card.get(new_top_card)
-        old_top_card = Card.get(old_top_card)
-        pile = self._tableau[old_top_card] + (new_top_card,)
-        self._tableau[new_top_card] = pile
-        del self._tableau[old_top_card]
-
-    def _put_in_new_pile(self, card):
-        """Place this card (Card, string, or tuple) in a new pile."""
-        assert len(self._tableau) < NUM_PILES
-        card = Card.get(card)
-        assert card not in self._tableau
-        self._tableau[card] = (card,)
-        
+        self._piles = piles
+        self._freecells = freecells
+        self._foundations = foundations
+        if hash_value is None:
+            hash_value = _full_hash(piles, freecells)
+        self._hash = hash_value
+        self._key = None
+        self._canonical = None
+        self._moved = moved
 
-class Card:
-    class _CardMap(object):
-        """Maps a card string to its pair of integers."""
-        
-        def __init__(self):
-            ranks = ['A']
-            for rank in xrange(2, 10):
-                ranks.append(str(rank))
-            ranks += ['T', 'J', 'Q', 'K']
-            
-            int_to_str = {}
-            str_to_int = {}
-            for rank_num, rank_name in enumerate(ranks, start=1):
-                for suit_num, suit_name in enumerate(SUITS):
-                    pair = (rank_num, suit_num)
-                    card_name = rank_name + suit_name
-                    int_to_str[pair] = card_name
-                    str_to_int[card_name] = pair
-
-            self._int_to_str = int_to_str
-            self._str_to_int = str_to_int
-
-        def str_to_int(self, card_str):
-            """Return the integer pair representing this card string.
-
-            card_str is a two-character string representing the card.
-            Letters may be upper or lower case.
-            """
-            return self._str_to_int[card_str.upper()]
-
-        def int_to_str(self, rank, suit):
-            """Return the string representing this card.
-            """
-            return self._int_to_str[(rank, suit)]
-
-    
     @classmethod
-    def get(cls, desc):
-        """Return a Card where desc describes the card.
-
-        desc can be a Card (it'll just be returned), (rank, suit)
-        tuple, or a 2-character card string.
+    def from_rows(cls, rows):
+        """Return a new state from these rows. Each row is a pile listed
+        from top to bottom as 2-character card strings (e.g. "3C"). Letters
+        may be upper or lower case.
         """
-        if isinstance(desc, Card):
-            return desc
-        if isinstance(desc, tuple):
-            return cls._from_ranksuit(*desc)
-        if isinstance(desc, str):
-            return cls._from_str(desc)
-        raise Exception('What card is this?: %s' % desc)
+        piles = []
+        made_codes = set()
+        for row in rows:
+            pile = ''
+            for card_str in row:
+                code = _CODE.get(card_str.strip().upper())
+                if code is None:
+                    raise Exception('What card is this?: %s' % card_str)
+                if code in made_codes:
+                    raise Exception('Duplicate card: %s' % _NAME[code])
+                pile += code
+                made_codes.add(code)
+            piles.append(pile)
+
+        if len(piles) != NUM_PILES:
+            raise Exception('Incorrect number of piles: %s' % len(piles))
+
+        if len(made_codes) != DECK_SIZE:
+            msg = 'These cards were not in the deal:\n'
+            for code in sorted(set(_NAME) - made_codes):
+                msg += '%s\n' % _NAME[code]
+            raise Exception(msg)
+
+        return cls(tuple(piles))
 
-    
     @classmethod
-    def _from_ranksuit(cls, rank, suit):
-        """Return a new Card. rank and suit are integers."""
-        pair = (rank, suit)
-        assert pair in cls._made_cards
-        card = cls._made_cards[pair]
-        if card is not None:
-            return card
-
-        rtn = cls()
-        rtn._suit = suit
-        rtn._rank = rank
-        rtn._is_red = suit < 2
-        cls._made_cards[pair] = rtn
+    def from_csv(cls, filename):
+        """Return a new state from this csv file."""
+        logging.info('Reading in the csv')
+        with open(filename) as file_obj:
+            rtn = cls.from_rows(csv.reader(file_obj))
+        logging.info('Done reading the csv')
         return rtn
 
     @classmethod
-    def _from_str(cls, card_str):
-        """Return a Card from the 2-character card string.
-
-        Letters are allowed to be upper or lower case.
+    def from_deal(cls, number):
+        """Return the deal with this number (from 1 to MAX_DEAL) in the
+        classic numbered-deal shuffle, which is the one Microsoft FreeCell
+        uses. A linear congruential generator seeded with the number picks
+        cards out of the deck, and they're dealt out across the piles.
+        """
+        if not 1 <= number <= MAX_DEAL:
+            raise Exception('There is no deal number %s' % number)
+        seed = number
+        deck = list(_DEAL_DECK)
+        piles = [''] * NUM_PILES
+        for index in xrange(DECK_SIZE):
+            seed = (seed * 214013 + 2531011) & MAX_DEAL
+            pick = (seed >> 16) % len(deck)
+            piles[index % NUM_PILES] += deck[pick]
+            deck[pick] = deck[-1]
+            deck.pop()
+        return cls(tuple(piles))
+
+    def key(self):
+        """Return a string that is the same for equal states and different
+        for unequal states. It is computed once and then cached.
         """
-        return cls._from_ranksuit(*cls._card_map.str_to_int(card_str))
+        if self._key is None:
+            self._key = self._freecells + _KEY_SEPARATOR + \
+                _KEY_SEPARATOR.join(sorted(self._piles))
+        return self._key
 
     @classmethod
-    def missing_cards(cls):
-        """Return the set of cards ((rank, suit) pairs) that were not 
-        instantiated.
-        """
-        return set(
-            pair 
-            for pair, card in cls._made_cards.iteritems() 
-            if card is None
-        )
-
-    @property
-    def suit(self):
-        """Return the numbered suit (from SUITS)"""
-        return self._suit
-
-    @property
-    def rank(self):
-        """Return a number for the rank (e.g. Ace is 1, and King is 
-        13)
+    def from_key(cls, key):
+        """Return a state equal to the one with this key. The foundations
+        hold the cards that aren't in the key.
         """
-        return self._rank
-
-    def goes_on_top_of(self, other):
-        """Return whether this card can go on top of other (Card, string, or
-        tuple.
+        parts = key.split(_KEY_SEPARATOR)
+        counts = [0] * len(SUITS)
+        for code in key:
+            if code != _KEY_SEPARATOR:
+                counts[_SUIT[code]] += 1
+        foundations = sum(
+            (MAX_RANK - num_cards) << (_FOUNDATION_BITS * suit)
+            for suit, num_cards in enumerate(counts)
+        )
+        return cls(tuple(parts[1:]), parts[0], foundations)
+
+    def canonical_key(self):
+        """Return a (key, swap) pair. The key is the same for states that
+        are equal after swapping the suits H and D and/or C and S, which
+        keeps the colors of the cards, so they are solved by the same moves
+        with the suits swapped. _SUIT_SWAPS[swap] is the swap from this
+        state to the one the key is for. It is computed once and then cached.
         """
-        other = Card.get(other)
-        return self._rank == other._rank - 1 and self._is_red != other._is_red
-
-    def is_red(self):
-        """Return True if the card is red; return False if it's black."""
-        return self._is_red
-
-    def __str__(self):
-        return self._card_map.int_to_str(self._rank, self._suit)
+        if self._canonical is None:
+            for swap, table in enumerate(_SUIT_SWAPS):
+                key = ''.join(sorted(self._freecells.translate(table))) + \
+                    _KEY_SEPARATOR + _KEY_SEPARATOR.join(
+                        sorted(pile.translate(table) for pile in self._piles)
+                    )
+                if self._canonical is None or key < self._canonical[0]:
+                    self._canonical = (key, swap)
+        return self._canonical
 
-    def __eq__(self, other):
-        return self._suit == other._suit and self._rank == other._rank
-
-    def __hash__(self):
-        return hash((self._suit, self._rank))
-
-    def __deepcopy__(self, _):
-        return self
+    def is_goal(self):
+        """Return whether or not we have won."""
+        return self._foundations == _GOAL_FOUNDATIONS
 
-    def __copy__(self):
-        return self        
+    def heuristic(self):
+        """Return a heuristic."""
+        return DECK_SIZE - sum(_foundation_ranks(self._foundations))
 
-    _card_map = _CardMap()
-    _made_cards = {
-        (rank, suit): None 
-        for rank in xrange(1, MAX_RANK+1) 
-        for suit in xrange(len(SUITS))
-    }
+    def buried(self):
+        """Return the number of cards in the tableau that are above a lower
+        card of the same suit. Each of them has to move somewhere other
+        than its foundation first.
+        """
+        rtn = 0
+        for pile in self._piles:
+            lowest = [MAX_RANK] * len(SUITS) # The lowest rank under the card
+            for code in pile:
+                suit = _SUIT[code]
+                rank = _RANK[code]
+                if rank > lowest[suit]:
+                    rtn += 1
+                else:
+                    lowest[suit] = rank
+        return rtn
 
+    def covering(self):
+        """Return the number of cards in the tableau that are above a card
+        that is next to go on its foundation.
+        """
+        needed = set(
+            _SUIT_CODES[suit][rank]
+            for suit, rank in enumerate(_foundation_ranks(self._foundations))
+            if rank < MAX_RANK
+        )
+        rtn = 0
+        for pile in self._piles:
+            for index, code in enumerate(pile):
+                if code in needed:
+                    rtn += len(pile) - index - 1
+                    break
+        return rtn
 
-class FreeCellState(object):
-    def __init__(self, filename):
-        """Return a new state from this csv file."""
-#        The value at index n refers to SUITS[n]. The value
-#        refers to the maximum rank on the foundation. If 0,
-#        the foundation is empty.
-        self._foundations = [0] * 4
+    def pattern_moves(self, database):
+        """Return a lower bound from this patterndb.PatternDatabase on the
+        number of cards besides the buried ones that have to move somewhere
+        other than their foundation first. The suits are split into two
+        pairs, the bounds of the pairs are added up, and the best of the
+        ways to split them is returned.
+        """
+        places = {}
+        for index, pile in enumerate(self._piles):
+            for height, code in enumerate(pile):
+                places[code] = (index, height)
+        windows = []
+        for suit, rank in enumerate(_foundation_ranks(self._foundations)):
+            codes = _SUIT_CODES[suit][rank:rank + patterndb.WINDOW]
+            windows.append(
+                [places.get(code) for code in codes] +
+                [None] * (patterndb.WINDOW - len(codes))
+            )
+        moves = {}
+        for first, second in _SUIT_PAIRS:
+            moves[first, second] = database.extra_moves(
+                patterndb.pattern_index(windows[first] + windows[second])
+            )
+        return max(
+            moves[first_pair] + moves[second_pair]
+            for first_pair, second_pair in _SUIT_PAIRINGS
+        )
 
-        self._freecells = set() # Set of cards
-        self._tableau = Tableau(filename)
+    def pressure(self):
+        """Return the number of occupied free cells that aren't offset by an
+        empty pile.
+        """
+        return max(0, len(self._freecells) - self._piles.count(''))
+
+    def _empty_pile(self):
+        """Return the index of an empty pile or None if there are none."""
+        try:
+            return self._piles.index('')
+        except ValueError:
+            return None
+
+    def _tops(self):
+        """Return a dict mapping the top card of each pile to the pile's
+        index.
+        """
+        return dict(
+            (pile[-1], index) for index, pile in enumerate(self._piles) if pile
+        )
 
-    def is_goal(self):
-        """Return whether or not we have won."""
-        return self._foundations == [MAX_RANK] * 4
+    def _placements(self, code, tops):
+        """Return a list of (piles, zobrist, move) tuples resulting from
+        placing the card with this code (which is not in the tableau) on the
+        tableau. zobrist is the key to xor into the hash. tops is the dict
+        from _tops.
+        """
+        rtn = []
+        piles = self._piles
+        for parent in _PARENTS[code]:
+            index = tops.get(parent)
+            if index is not None:
+                rtn.append((
+                    _with_pile(piles, index, piles[index] + code),
+                    _ZOBRIST[code][parent],
+                    _move(ON_CARD, code, parent)
+                ))
+
+        empty = self._empty_pile()
+        if empty is not None:
+            rtn.append((
+                _with_pile(piles, empty, code),
+                _ZOBRIST[code][_PILE_BOTTOM],
+                _move(NEW_PILE, code)
+            ))
 
-    def heuristic(self):
-        """Return a heuristic."""
-        return DECK_SIZE - sum(self._foundations)
+        return rtn
 
-    def _trivial_next_state(self):
+    def _trivial_next_state(self, tops):
         """Return a (state, move, cost) tuple for obvious moves. If there
         are no obvious moves, return None.
         """
-        moves = []
-        state = deepcopy(self)
+        moves = ''
+        tops = dict(tops)
+        piles = self._piles
+        freecells = self._freecells
+        foundations = self._foundations
+        hash_value = self._hash
         while True:
             change = False
-            min_rank = min(state._foundations)
-            for suit, top_rank in enumerate(state._foundations):
+            ranks = _foundation_ranks(foundations)
+            min_rank = min(ranks)
+            for suit, top_rank in enumerate(ranks):
                 if top_rank - min_rank <= 1 and top_rank < MAX_RANK:
-                    card_to_find = Card.get((top_rank+1, suit))
-                    if card_to_find in state._freecells or \
-                     card_to_find in state._tableau:
-                        change = True
-                        if card_to_find in state._freecells:
-                            state._freecells.remove(card_to_find)
-                        else:
-                            state._tableau = state._tableau.remove(card_to_find)
-                        state._foundations[suit] = card_to_find.rank
-                        moves.append('Put %s in its foundation.' % card_to_find)
+                    code = _SUIT_CODES[suit][top_rank]
+                    if code in freecells:
+                        freecells = freecells.replace(code, '')
+                        hash_value ^= _ZOBRIST[code][_FREECELL]
+                    elif code in tops:
+                        index = tops.pop(code)
+                        pile = piles[index]
+                        hash_value ^= _ZOBRIST[code][_top_location(pile)]
+                        piles = _with_pile(piles, index, pile[:-1])
+                        if len(pile) > 1:
+                            tops[pile[-2]] = index
+                    else:
+                        continue
+                    change = True
+                    foundations += _FOUNDATION_UNIT[suit]
+                    moves += code
             if not change:
                 break
 
-        return (state, '\n'.join(moves), len(moves)) if moves else None
-            
+        if not moves:
+            return None
+        state = FreeCellState(piles, freecells, foundations, hash_value)
+        return state, _move(AUTO_FOUNDATION, moves), len(moves)
 
-    def _tableau_to_foundations(self):
-        """Return a list of (state, move, cost) tuples from the tableau to the
+    def _tableau_to_foundations(self, tops):
+        """Yield the (state, move, cost) tuples from the tableau to the
         foundations.
         """
-        rtn = []
-        for card in self._tableau.top_cards():
-            if card.rank == self._foundations[card.suit] + 1:
-                new_tableau = self._tableau.remove(card)
-                new_state = deepcopy(self)
-                new_state._foundations[card.suit] += 1
-                new_state._tableau = new_tableau
-                rtn.append((new_state, 'Move %s to its foundation.' % card, 1))
-
-        return rtn
+        for suit, rank in enumerate(_foundation_ranks(self._foundations)):
+            if rank == MAX_RANK:
+                continue
+            code = _SUIT_CODES[suit][rank]
+            index = tops.get(code)
+            if index is not None:
+                pile = self._piles[index]
+                new_state = FreeCellState(
+                    _with_pile(self._piles, index, pile[:-1]),
+                    self._freecells,
+                    self._foundations + _FOUNDATION_UNIT[suit],
+                    self._hash ^ _ZOBRIST[code][_top_location(pile)]
+                )
+                yield (new_state, _move(TABLEAU_TO_FOUNDATION, code), 1)
 
-    def _foundations_to_tableau(self):
-        """Return a list of (state, move, cost) tuples from the foundations to
-        the tableau.
+    def _foundations_to_tableau(self, tops):
+        """Yield the (state, move, cost) tuples from the foundations to
+        the tableau, except for cards that would go straight back (see
+        _plays_back).
         """
-        rtn = []
-        for suit, rank in enumerate(self._foundations):
-            if rank != 0:
-                for tableau, move in self._tableau.place((rank, suit)):
-                    new_state = deepcopy(self)
-                    new_state._tableau = tableau
-                    new_state._foundations[suit] -= 1
-                    rtn.append((new_state, move, 1))
-
-        return rtn                
-
-    def _tableau_moves(self):
-        """Return a list of (state, move, cost) tuples from moving cards within
-        the tableau.
+        ranks = _foundation_ranks(self._foundations)
+        for suit, rank in enumerate(ranks):
+            if rank != 0 and not _plays_back(ranks, suit):
+                code = _SUIT_CODES[suit][rank - 1]
+                foundations = self._foundations - _FOUNDATION_UNIT[suit]
+                for piles, zobrist, move in self._placements(code, tops):
+                    new_state = FreeCellState(
+                        piles, self._freecells, foundations,
+                        self._hash ^ zobrist
+                    )
+                    yield (new_state, move, 1)
+
+    def _tableau_moves(self, tops, sources=None):
+        """Yield the (state, move, cost) tuples from moving cards within
+        the tableau, from the piles with these indices in this order (all of
+        them by default). A sequence of cards moves at once if there are
+        enough free cells and empty piles to move it a card at a time. It
+        costs one per card.
         """
-        rtn = []
-        for tableau, move in self._tableau.internal_moves():
-            new_state = deepcopy(self)
-            new_state._tableau = tableau
-            rtn.append((new_state, move, 1))
-        return rtn
+        piles = self._piles
+        free = NUM_FREECELLS - len(self._freecells)
+        num_empty = piles.count('')
+        empty = self._empty_pile()
+        if sources is None:
+            sources = xrange(NUM_PILES)
+        for src in sources:
+            pile = piles[src]
+            if not pile:
+                continue
+            run = _run_length(pile)
+
+            # Put cards in a new pile
+            if empty is not None:
+                max_length = min(
+                    run, len(pile) - 1, _supermove_capacity(free, num_empty - 1)
+                )
+                for length in xrange(1, max_length + 1):
+                    cards = pile[-length:]
+                    new_piles = _with_pile(piles, src, pile[:-length])
+                    new_piles = _with_pile(new_piles, empty, cards)
+                    hash_value = self._hash ^ \
+                        _ZOBRIST[cards[0]][pile[-length-1]] ^ \
+                        _ZOBRIST[cards[0]][_PILE_BOTTOM]
+                    if length == 1:
+                        move = _move(NEW_PILE, cards)
+                    else:
+                        move = _move(SEQUENCE_NEW_PILE, cards)
+                    yield (
+                        FreeCellState(
+                            new_piles, self._freecells, self._foundations,
+                            hash_value
+                        ),
+                        move,
+                        length
+                    )
+
+            # Put cards on top of other cards
+            max_length = min(run, _supermove_capacity(free, num_empty))
+            for length in xrange(1, max_length + 1):
+                cards = pile[-length:]
+                for parent in _PARENTS[cards[0]]:
+                    dest = tops.get(parent)
+                    if dest is None:
+                        continue
+                    if length < len(pile):
+                        below = pile[-length-1]
+                    else:
+                        below = _PILE_BOTTOM
+                    new_piles = _with_pile(piles, src, pile[:-length])
+                    new_piles = _with_pile(new_piles, dest, piles[dest] + cards)
+                    hash_value = self._hash ^ _ZOBRIST[cards[0]][below] ^ \
+                        _ZOBRIST[cards[0]][parent]
+                    if length == 1:
+                        move = _move(ON_CARD, cards, parent)
+                    else:
+                        move = _move(SEQUENCE_ON_CARD, cards, parent)
+                    yield (
+                        FreeCellState(
+                            new_piles, self._freecells, self._foundations,
+                            hash_value
+                        ),
+                        move,
+                        length
+                    )
 
     def _tableau_to_free(self):
-        """Return a list of (state, move, cost) tuples from moving cards from
+        """Yield the (state, move, cost) tuples from moving cards from
         the tableau to the free cells.
         """
         if len(self._freecells) == NUM_FREECELLS:
-            return []
-
-        rtn = []
-
-        for card in self._tableau.top_cards():
-            new_tableau = self._tableau.remove(card)
-            new_state = deepcopy(self)
-            new_state._tableau = new_tableau
-            new_state._freecells.add(card)
-            rtn.append((new_state, 'Put %s in a free cell.' % card, 1))
-
-        return rtn
+            return
+
+        for index, pile in enumerate(self._piles):
+            if pile:
+                code = pile[-1]
+                new_state = FreeCellState(
+                    _with_pile(self._piles, index, pile[:-1]),
+                    ''.join(sorted(self._freecells + code)),
+                    self._foundations,
+                    self._hash ^ _ZOBRIST[code][_top_location(pile)] ^
+                    _ZOBRIST[code][_FREECELL]
+                )
+                yield (new_state, _move(TO_FREECELL, code), 1)
 
-    def _free_to_tableau(self):
-        """Return a list of (state, move, cost) tuples from moving cards from
+    def _free_to_tableau(self, tops):
+        """Yield the (state, move, cost) tuples from moving cards from
         the free cells to the tableau.
         """
-        rtn = []
-        for card in self._freecells:
-            for tableau, move in self._tableau.place(card):
-                state = deepcopy(self)
-                state._tableau = tableau
-                state._freecells.remove(card)
-                rtn.append((state, move, 1))
-
-        return rtn
+        for code in self._freecells:
+            freecells = self._freecells.replace(code, '')
+            hash_value = self._hash ^ _ZOBRIST[code][_FREECELL]
+            for piles, zobrist, move in self._placements(code, tops):
+                state = FreeCellState(
+                    piles, freecells, self._foundations, hash_value ^ zobrist
+                )
+                yield (state, move, 1)
 
     def _free_to_foundations(self):
-        """Return a list of (state, move, cost) tuples from moving cards from
+        """Yield the (state, move, cost) tuples from moving cards from
         the free cells to the foundations.
         """
-        rtn = []
-        for card in self._freecells:
-            if card.rank == self._foundations[card.suit] + 1:
-                state = deepcopy(self)
-                state._foundations[card.suit] = card.rank
-                state._freecells.remove(card)
-                rtn.append((state, 'Put %s in its foundation.' % card, 1))
-
-        return rtn
+        ranks = _foundation_ranks(self._foundations)
+        for code in self._freecells:
+            suit = _SUIT[code]
+            if _RANK[code] == ranks[suit] + 1:
+                state = FreeCellState(
+                    self._piles,
+                    self._freecells.replace(code, ''),
+                    self._foundations + _FOUNDATION_UNIT[suit],
+                    self._hash ^ _ZOBRIST[code][_FREECELL]
+                )
+                yield (state, _move(FREE_TO_FOUNDATION, code), 1)
 
     def _foundations_to_free(self):
-        """Return a list of (state, move, cost) tuples from moving cards from
-        the foundations to the free cells.
+        """Yield the (state, move, cost) tuples from moving cards from
+        the foundations to the free cells, except for cards that would go
+        straight back (see _plays_back).
         """
         if len(self._freecells) == NUM_FREECELLS:
-            return []
+            return
+
+        ranks = _foundation_ranks(self._foundations)
+        for suit, rank in enumerate(ranks):
+            if rank != 0 and not _plays_back(ranks, suit):
+                code = _SUIT_CODES[suit][rank - 1]
+                state = FreeCellState(
+                    self._piles,
+                    ''.join(sorted(self._freecells + code)),
+                    self._foundations - _FOUNDATION_UNIT[suit],
+                    self._hash ^ _ZOBRIST[code][_FREECELL]
+                )
+                yield (state, _move(TO_FREECELL, code), 1)
 
-        rtn = []
+    def __hash__(self):
+        return self._hash
 
-        for suit, rank in enumerate(self._foundations):
-            if rank != 0:
-                state = deepcopy(self)
-                state._foundations[suit] -= 1
-                card = Card.get((rank, suit))
-                state._freecells.add(card)
-                rtn.append((state, 'Put %s in a free cell.' % card, 1))
+    def __reduce__(self):
+        return FreeCellState, (
+            self._piles, self._freecells, self._foundations, self._hash,
+            self._moved
+        )
 
-        return rtn
+    def __eq__(self, other):
+        return self._hash == other._hash and self.key() == other.key()
 
-    def __hash__(self):
-        return hash((
-            frozenset(self._freecells), 
-            tuple(self._foundations), 
-            frozenset(self._tableau.piles())
-        ))
+    def __ne__(self, other):
+        return not self == other
 
-    def __eq__(self, other):
-        return self._foundations == other._foundations and \
-            self._tableau == other._tableau and \
-            self._freecells == other._freecells
-
-    def __deepcopy__(self, _):
-        rtn = copy(self)
-        rtn._foundations = self._foundations[:]
-        rtn._freecells = self._freecells.copy()
-        return rtn
+    def _digging_order(self):
+        """Return the indices of the piles, starting with the ones that
+        have the fewest cards above a card that is next to go on its
+        foundation. Piles without such a card come last.
+        """
+        needed = [
+            _SUIT_CODES[suit][rank]
+            for suit, rank in enumerate(_foundation_ranks(self._foundations))
+            if rank < MAX_RANK
+        ]
+        depths = []
+        for index, pile in enumerate(self._piles):
+            depth = DECK_SIZE
+            for code in needed:
+                found = pile.rfind(code)
+                if found != -1 and len(pile) - found < depth:
+                    depth = len(pile) - found
+            depths.append((depth, index))
+        return [index for _, index in sorted(depths)]
+
+    def _is_dead_end(self):
+        """Return whether this state is sure to have no successors, which
+        is only checked when the free cells are full and there are no empty
+        piles. Then only single cards can move, and it's a dead end if none
+        but the one that was just moved can go on a foundation or on top of
+        another card.
+        """
+        if len(self._freecells) < NUM_FREECELLS or '' in self._piles:
+            return False
+        ranks = _foundation_ranks(self._foundations)
+        tops = set(pile[-1] for pile in self._piles)
+        for code in chain(self._freecells, tops):
+            if code == self._moved:
+                continue
+            if _RANK[code] == ranks[_SUIT[code]] + 1:
+                return False
+            for parent in _PARENTS[code]:
+                if parent in tops:
+                    return False
+        for suit, rank in enumerate(ranks):
+            code = _SUIT_CODES[suit][rank - 1]
+            if rank != 0 and code != self._moved and \
+             not _plays_back(ranks, suit):
+                for parent in _PARENTS[code]:
+                    if parent in tops:
+                        return False
+        return True
+
+    def _pruned(self, successors):
+        """Yield the (state, move, cost) tuples from successors that are
+        worth searching, and set the card each state's move moved.
+
+        A move of the card the move to this state moved (or of a sequence
+        starting with it) is left out. Either it moves the card back, or it
+        could have gone there straight from where it was, for no more cost,
+        since nothing else has changed. This doesn't apply after
+        AUTO_FOUNDATION moves, since they're the only move from their
+        state. Successors that are dead ends (see _is_dead_end) are left out
+        too.
+
+        Moves to a free cell aren't left out when the card could go to an
+        empty pile instead. An empty pile is worth more than a free cell,
+        since it doubles how many cards a sequence move can take, so
+        keeping the pile empty can be the better move.
+        """
+        moved = self._moved
+        for successor in successors:
+            state, move, _ = successor
+            card = move[1][0]
+            if card == moved:
+                continue
+            if move[0] != AUTO_FOUNDATION:
+                state._moved = card
+                if state._is_dead_end():
+                    continue
+            yield successor
+
+    def iter_next_states(self):
+        """Yield the (state, move, cost) tuples, the most promising first:
+        moves to the foundations, then moves within the tableau from the
+        piles that are closest to freeing a card for the foundations, then
+        moves from the free cells, and moves to the free cells last. Each
+        state is made only when it's asked for. Pointless moves are left
+        out (see _pruned).
+        """
+        tops = self._tops()
+        trivial_pair = self._trivial_next_state(tops)
+        if trivial_pair is not None:
+            for successor in self._pruned([trivial_pair]):
+                yield successor
+            return
+
+        for successor in self._pruned(chain(
+            self._tableau_to_foundations(tops),
+            self._free_to_foundations(),
+            self._tableau_moves(tops, self._digging_order()),
+            self._free_to_tableau(tops),
+            self._foundations_to_tableau(tops),
+            self._tableau_to_free(),
+            self._foundations_to_free()
+        )):
+            yield successor
 
     def next_states(self):
-        """Return a list of (state, move, cost) tuples."""
-        trivial_pair = self._trivial_next_state()
+        """Return a list of (state, move, cost) tuples, leaving out
+        pointless moves (see _pruned).
+        """
+        tops = self._tops()
+        trivial_pair = self._trivial_next_state(tops)
         if trivial_pair is not None:
-            return [trivial_pair]
+            return list(self._pruned([trivial_pair]))
+
+        return list(self._pruned(chain(
+            self._tableau_to_foundations(tops),
+            self._foundations_to_tableau(tops),
+            self._tableau_moves(tops),
+            self._tableau_to_free(),
+            self._free_to_tableau(tops),
+            self._free_to_foundations(),
+            self._foundations_to_free()
+        )))
 
-        rtn = []
-        rtn += self._tableau_to_foundations()
-        rtn += self._foundations_to_tableau()
-        rtn += self._tableau_moves()
-        rtn += self._tableau_to_free()
-        rtn += self._free_to_tableau()
-        rtn += self._free_to_foundations()
-        rtn += self._foundations_to_free()
+        
+def buried_heuristic(state):
+    """Return the cards left plus the cards that have to move out of the
+    way of a lower card of their suit. This never overestimates.
+    """
+    return state.heuristic() + state.buried()
+
+
+def next_card_heuristic(state):
+    """Return buried_heuristic plus the number of cards covering the next
+    card of each foundation. This may overestimate.
+    """
+    return buried_heuristic(state) + state.covering()
+
+
+def pressure_heuristic(state):
+    """Return next_card_heuristic plus a penalty for filling the free cells
+    without having empty piles. This may overestimate.
+    """
+    return next_card_heuristic(state) + state.pressure()
+
+
+# The patterndb.PatternDatabase for pattern_heuristic (or None)
+_pattern_db = None
+
+
+def load_pattern_db(filename=patterndb.DEFAULT_FILENAME):
+    """Load the pattern database for pattern_heuristic from this file
+    (built by patterndb.py). It's memory mapped, so worker processes
+    started after this share it.
+    """
+    global _pattern_db
+    _pattern_db = patterndb.PatternDatabase(filename)
+
+
+def pattern_heuristic(state):
+    """Return buried_heuristic plus the bound from the pattern database
+    (see FreeCellState.pattern_moves). This never overestimates. The
+    database has to be loaded first (see load_pattern_db).
+    """
+    if _pattern_db is None:
+        raise Exception('The pattern database is not loaded')
+    return buried_heuristic(state) + state.pattern_moves(_pattern_db)
+
+
+def _cards_left_batch(states):
+    """Return a numpy array of FreeCellState.heuristic of each state."""
+    foundations = numpy.array(
+        [state._foundations for state in states], dtype=numpy.int64
+    )
+    shifts = _FOUNDATION_BITS * numpy.arange(len(SUITS))
+    ranks = (foundations[:, numpy.newaxis] >> shifts) & _FOUNDATION_MASK
+    return DECK_SIZE - ranks.sum(axis=1)
+
+
+def _buried_batch(states):
+    """Return a numpy array of FreeCellState.buried of each state.
+
+    The piles are padded with _PILE_BOTTOM (which has no suit) to the same
+    height and put in an array of card codes by state, pile and height, so
+    each suit is counted with one cumulative minimum over the heights.
+    """
+    height = max(
+        len(pile) for state in states for pile in state._piles
+    ) or 1
+    codes = numpy.frombuffer(
+        ''.join(
+            pile.ljust(height, _PILE_BOTTOM)
+            for state in states for pile in state._piles
+        ),
+        dtype=numpy.uint8
+    ).reshape(len(states), NUM_PILES, height).astype(numpy.int16)
+    suits = codes // MAX_RANK
+    ranks = codes % MAX_RANK
+    rtn = numpy.zeros(len(states), dtype=numpy.int64)
+    for suit in xrange(len(SUITS)):
+        in_suit = suits == suit
+        # The lowest rank of the suit at or under each card
+        lowest = numpy.minimum.accumulate(
+            numpy.where(in_suit, ranks, MAX_RANK), axis=2
+        )
+        under = numpy.concatenate((
+            numpy.full(lowest.shape[:2] + (1,), MAX_RANK, dtype=lowest.dtype),
+            lowest[:, :, :-1]
+        ), axis=2)
+        rtn += (in_suit & (ranks > under)).sum(axis=(1, 2))
+    return rtn
+
+
+def _buried_heuristic_batch(states):
+    """Return a numpy array of buried_heuristic of each state."""
+    return _cards_left_batch(states) + _buried_batch(states)
+
+
+# Maps a heuristic name to a function from a list of states to a numpy
+# array of their heuristics, for FreeCellProblem.heuristic_batch.
+_HEURISTIC_BATCHES = {
+    'foundations': _cards_left_batch,
+    'buried': _buried_heuristic_batch,
+}
+
+# Smaller batches are faster one state at a time than through numpy.
+_MIN_NUMPY_BATCH = 16
+
+# numpy is imported by import_numpy, the first time a batch needs it, since
+# it adds about 9 MB to every process that imports it. It's None until then
+# and if it isn't installed.
+numpy = None
+_numpy_tried = False
+
+
+def import_numpy():
+    """Import numpy if it hasn't been tried yet, and return whether it's
+    installed.
+    """
+    global numpy, _numpy_tried
+    if not _numpy_tried:
+        _numpy_tried = True
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy is not None
+
+
+# The names of the heuristics in HEURISTICS that never overestimate
+_ADMISSIBLE_HEURISTICS = ('foundations', 'buried', 'pattern')
+
+# Maps a heuristic name to a function from a state to its heuristic.
+HEURISTICS = {
+    'foundations': FreeCellState.heuristic,
+    'buried': buried_heuristic,
+    'next_card': next_card_heuristic,
+    'pressure': pressure_heuristic,
+    'pattern': pattern_heuristic,
+}
 
-        return rtn
 
-        
 class FreeCellProblem(Problem):
-    def __init__(self, filename):
-        """Read in a FreeCell game."""
-        self._init_state = FreeCellState(filename)
+    def __init__(self, deal, heuristic='foundations'):
+        """Set up a FreeCell game. deal is a csv file to read it from, a
+        deal number (see FreeCellState.from_deal) or a FreeCellState.
+        heuristic is a name from HEURISTICS or a function from a
+        FreeCellState to its heuristic. admissible is whether it's one of
+        the heuristics that never overestimate.
+        """
+        if isinstance(deal, FreeCellState):
+            self._init_state = deal
+        elif isinstance(deal, (int, long)):
+            self._init_state = FreeCellState.from_deal(deal)
+        else:
+            self._init_state = FreeCellState.from_csv(deal)
+        self._heuristic_batch = None
+        self.admissible = heuristic in _ADMISSIBLE_HEURISTICS
+        if isinstance(heuristic, basestring):
+            self._heuristic_name = heuristic
+        else:
+            self._heuristic_name = '%s.%s' % (
+                heuristic.__module__, heuristic.__name__
+            )
+        if isinstance(heuristic, basestring):
+            self._heuristic_batch = _HEURISTIC_BATCHES.get(heuristic)
+            heuristic = HEURISTICS[heuristic]
+        self._heuristic = heuristic
 
     def initial_state(self):
         return self._init_state
@@ -514,27 +1118,951 @@ class FreeCellProblem(Problem):
     def next_states(self, state):
         return state.next_states()
 
+    def iter_next_states(self, state):
+        return state.iter_next_states()
+
     def heuristic(self, state):
-        return state.heuristic()
+        return self._heuristic(state)
+
+    def heuristic_name(self):
+        """Return the name from HEURISTICS, or the module and name of the
+        heuristic function.
+        """
+        return self._heuristic_name
+
+    def heuristic_batch(self, states):
+        """Return the list of the heuristics of these states, computed
+        together with numpy for the heuristics in _HEURISTIC_BATCHES if
+        it's installed.
+        """
+        if self._heuristic_batch is None or \
+         len(states) < _MIN_NUMPY_BATCH or not import_numpy():
+            return [self._heuristic(state) for state in states]
+        return self._heuristic_batch(states).tolist()
+
+    def progress(self, state):
+        """Return the number of cards on the foundations."""
+        return DECK_SIZE - state.heuristic()
+
+    def move_kind(self, move):
+        """Return the kind of the move (e.g. ON_CARD). This isn't which
+        FreeCellState generator made it: ON_CARD and NEW_PILE moves come
+        from the tableau, the free cells and the foundations, and
+        TO_FREECELL moves from the tableau and the foundations. A move
+        doesn't say where its card was.
+        """
+        return move[0]
+
+    def symmetry_key(self, state):
+        return state.canonical_key()[0]
+
+    def encode_state(self, state):
+        return state.key()
+
+    def decode_state(self, encoded):
+        return FreeCellState.from_key(encoded)
+
+    def encode_moves(self, moves):
+        return _encode_moves(moves)
+
+    def decode_moves(self, encoded):
+        return _decode_moves(encoded)
+
+
+ALGORITHMS = ('astar', 'idastar', 'beam', 'dfs', 'external', 'hdastar')
+
+
+class SolutionCache(object):
+    """A persistent store of solutions in an sqlite database.
+
+    Deals are looked up by FreeCellState.canonical_key, so a solution is
+    shared by deals that differ only in the order of their piles or by
+    swapping H with D and C with S. The moves are stored for the canonical
+    deal and swapped back for the deal asked about. At most max_entries
+    solutions are kept, dropping the least recently used. The time a
+    solution was used is only updated after _TOUCH_SECONDS, so most lookups
+    don't write.
+
+    Each solution is stored with its cost and its bound: it costs at most
+    the bound times the cheapest solution's cost, or the bound is None if
+    nothing is known (see _cost_bound). A lookup only returns a solution
+    whose bound is as good as the one the caller asks for.
+    """
+
+    _TOUCH_SECONDS = 60
+
+    # The version of the table layout, kept in the database's user_version.
+    # A database with an older one is emptied.
+    _VERSION = 1
+
+    def __init__(self, filename, max_entries=100000):
+        self._max_entries = max_entries
+        self._db = sqlite3.connect(filename, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        version = self._db.execute('PRAGMA user_version').fetchone()[0]
+        if version != self._VERSION:
+            self._db.execute('DROP TABLE IF EXISTS solutions')
+            self._db.execute('PRAGMA user_version = %d' % self._VERSION)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS solutions ('
+            'key BLOB PRIMARY KEY, moves BLOB NOT NULL, '
+            'cost INTEGER NOT NULL, bound REAL, used REAL NOT NULL)'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS solutions_used ON solutions (used)'
+        )
+
+    def get(self, state, bound=None):
+        """Return the stored moves that solve this state with this bound or
+        a better one, or None.
+        """
+        key, swap = state.canonical_key()
+        key = buffer(key)
+        row = self._db.execute(
+            'SELECT moves, bound, used FROM solutions WHERE key = ?', (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        moves, stored_bound, used = row
+        if bound is not None and \
+         (stored_bound is None or stored_bound > bound):
+            return None
+        crnt_time = time()
+        if crnt_time - used > self._TOUCH_SECONDS:
+            self._db.execute(
+                'UPDATE solutions SET used = ? WHERE key = ?', (crnt_time, key)
+            )
+        return _decode_moves(str(moves).translate(_SUIT_SWAPS[swap]))
+
+    def put(self, state, moves, bound=None):
+        """Store these moves that solve this state with this bound, unless a
+        solution that costs as little is already stored.
+
+        The cheaper of two solutions is within the bounds of both, so the
+        one kept gets the better bound.
+        """
+        key, swap = state.canonical_key()
+        key = buffer(key)
+        cost = _moves_cost(moves)
+        row = self._db.execute(
+            'SELECT cost, bound FROM solutions WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None:
+            stored_cost, stored_bound = row
+            if stored_bound is not None and \
+             (bound is None or stored_bound < bound):
+                bound = stored_bound
+            if stored_cost <= cost:
+                if bound != stored_bound:
+                    self._db.execute(
+                        'UPDATE solutions SET bound = ? WHERE key = ?',
+                        (bound, key)
+                    )
+                return
+        stored = _encode_moves(moves).translate(_SUIT_SWAPS[swap])
+        self._db.execute(
+            'INSERT OR REPLACE INTO solutions VALUES (?, ?, ?, ?, ?)',
+            (key, buffer(stored), cost, bound, time())
+        )
+        excess = self._db.execute(
+            'SELECT COUNT(*) FROM solutions'
+        ).fetchone()[0] - self._max_entries
+        if excess > 0:
+            self._db.execute(
+                'DELETE FROM solutions WHERE key IN '
+                '(SELECT key FROM solutions ORDER BY used LIMIT ?)',
+                (excess,)
+            )
+
+    def close(self):
+        self._db.close()
+
+
+def _moves_cost(moves):
+    """Return the cost of these moves: the number of cards they move."""
+    return sum(len(move[1]) for move in moves)
+
+
+def _cost_bound(problem, algorithm, weight):
+    """Return the most times the cheapest solution's cost that a solution
+    from this algorithm and weight can cost, or None if there's no bound.
+    The A* searches (and IDA*) find solutions within weight times the
+    cheapest if the problem's heuristic never overestimates.
+    """
+    if algorithm in ('beam', 'dfs') or not problem.admissible:
+        return None
+    return weight
+
+
+def solve(
+    problem, algorithm='astar', weight=1, workers=None, width=1000,
+    table_size=100000, symmetry=False, spill_dir=None, checkpoint=None,
+    checkpoint_seconds=300, resume=False, cache=None, **budget
+):
+    """Return the moves solving this problem with this algorithm (from
+    ALGORITHMS) or None if it finds no solution. weight multiplies the
+    heuristic. workers is for hdastar, width is for beam, table_size is
+    for idastar, symmetry, checkpoint, checkpoint_seconds and resume are
+    for astar, and spill_dir is the directory for external's files. budget
+    is keyword arguments for the search's budget and stats (see
+    search.astar).
+
+    If cache (a SolutionCache) has a solution for the initial state that
+    is bounded as well as one from this search would be (see _cost_bound),
+    it's returned without searching. Solutions found are stored in it.
+    """
+    if cache is not None:
+        init_state = problem.initial_state()
+        bound = _cost_bound(problem, algorithm, weight)
+        moves = cache.get(init_state, bound)
+        if moves is None:
+            moves = solve(
+                problem, algorithm, weight, workers, width, table_size,
+                symmetry, spill_dir, checkpoint, checkpoint_seconds, resume,
+                **budget
+            )
+            if moves is not None:
+                cache.put(init_state, moves, bound)
+        return moves
+    if algorithm == 'astar':
+        return astar(
+            problem, weight, symmetry=symmetry, checkpoint=checkpoint,
+            checkpoint_seconds=checkpoint_seconds, resume=resume, **budget
+        )
+    if symmetry:
+        raise Exception('Only astar prunes symmetric states')
+    if checkpoint is not None:
+        raise Exception('Only astar saves checkpoints')
+    if algorithm == 'idastar':
+        return idastar(problem, weight, table_size, **budget)
+    if algorithm == 'beam':
+        return beam(problem, width, weight, **budget)
+    if algorithm == 'dfs':
+        return dfs(problem, **budget)
+    if algorithm == 'external':
+        return external_astar(problem, weight, spill_dir, **budget)
+    if algorithm == 'hdastar':
+        return hdastar(problem, workers, weight, **budget)
+    raise Exception('What algorithm is this?: %s' % algorithm)
+
+
+def _deal_files(paths):
+    """Return the list of csv files in these paths. A path is a csv file or
+    a directory of csv files.
+    """
+    rtn = []
+    for path in paths:
+        if os.path.isdir(path):
+            rtn += sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.lower().endswith('.csv')
+            )
+        else:
+            rtn.append(path)
+    return rtn
+
+
+def _deal_numbers(spec):
+    """Return the list of xranges of deal numbers in this spec, a
+    comma-separated list of numbers and ranges (e.g. "1..100"). Only the
+    ends of a range are checked, and it isn't built up front.
+    """
+    ends = []
+    try:
+        for part in spec.split(','):
+            if '..' in part:
+                first, last = part.split('..')
+                ends.append((int(first), int(last)))
+            else:
+                ends.append((int(part), int(part)))
+    except ValueError:
+        raise argparse.ArgumentTypeError('What deals are these?: %s' % spec)
+    for first, last in ends:
+        if first > last:
+            continue
+        for number in first, last:
+            if not 1 <= number <= MAX_DEAL:
+                raise argparse.ArgumentTypeError(
+                    'There is no deal number %s' % number
+                )
+    return [xrange(first, last + 1) for first, last in ends]
+
+
+# The SolutionCache of a batch worker process (or None)
+_worker_cache = None
+
+
+def _init_worker(cache_args):
+    """Quiet the logging in a batch worker process and open its cache.
+    cache_args are the arguments for SolutionCache or None for no cache.
+    """
+    global _worker_cache
+    logging.basicConfig(level=logging.WARNING)
+    if cache_args is not None:
+        _worker_cache = SolutionCache(*cache_args)
+
+
+def _solve_deal(job):
+    """Solve the deal in a batch worker and return its result record.
+    job is a (deal for FreeCellProblem, heuristic, keyword arguments for
+    solve, whether to add the search's stats) tuple.
+    """
+    deal, heuristic, options, with_stats = job
+    rtn = {'deal': deal}
+    stats = SearchStats() if with_stats else None
+    try:
+        result = SearchResult.of(
+            solve, FreeCellProblem(deal, heuristic), stats=stats,
+            cache=_worker_cache, **options
+        )
+    except Exception as exc:
+        rtn['status'] = 'error'
+        rtn['error'] = str(exc)
+        return rtn
+    rtn['status'] = result.status
+    rtn['seconds'] = round(result.seconds, 3)
+    if result.reason is not None:
+        rtn['error'] = result.reason
+    if result.moves is not None:
+        key = 'moves' if result.status == SearchResult.SOLVED else 'partial'
+        rtn[key] = [move_to_dict(move) for move in result.moves]
+    if stats is not None:
+        rtn['stats'] = stats.to_dict()
+    return rtn
+
+
+# The resident megabytes after a task over which a pool worker is replaced,
+# without a memory budget
+_RECYCLE_MEGABYTES = 256
+
+
+def _recycle_megabytes(max_memory):
+    """Return the resident megabytes after a task over which a _WorkerPool
+    worker is replaced: half of the max_memory budget, or
+    _RECYCLE_MEGABYTES if it's None.
+    """
+    if max_memory is None:
+        return _RECYCLE_MEGABYTES
+    return max_memory / 2.0
+
+
+def _pool_worker(tasks, results, cache_args, recycle_megabytes):
+    """Run the tasks of a _WorkerPool until it sends None, or until this
+    process's resident memory after a task is over recycle_megabytes.
+    """
+    # Interrupts are for the parent, which stops the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_worker(cache_args)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        number, func, arg = task
+        try:
+            result = func(arg)
+        except Exception as exc:
+            # The tasks catch their own errors, but the worker must answer.
+            result = {'status': 'error', 'error': str(exc)}
+        rss = _rss_megabytes()
+        recycle = rss is not None and rss > recycle_megabytes
+        results.put((number, result, os.getpid() if recycle else None))
+        if recycle:
+            return
+
+
+class _WorkerPool(object):
+    """A pool of worker processes (set up by _init_worker) for solve_batch
+    and serve.
+
+    The workers are forked, so a task doesn't pay for starting Python,
+    imports and setting up tables. Unlike a multiprocessing.Pool with
+    maxtasksperchild, a worker is only replaced when its resident memory
+    after a task is over recycle_megabytes, so the memory a big search
+    leaves behind doesn't count against the next one's budget and stats,
+    but small tasks don't each wait for a new process.
+    """
+
+    def __init__(self, workers=None, cache_args=None, recycle_megabytes=None):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        if recycle_megabytes is None:
+            recycle_megabytes = _RECYCLE_MEGABYTES
+        self._workers = workers
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._worker_args = (
+            self._tasks, self._results, cache_args, recycle_megabytes
+        )
+        self._processes = {} # Maps a worker's pid to its Process
+        self._callbacks = {} # Maps a task number to (callback, Event)
+        self._counter = count()
+        self._lock = threading.Lock()
+        for _ in xrange(workers):
+            self._start_worker()
+        self._handler = threading.Thread(target=self._handle_results)
+        self._handler.daemon = True
+        self._handler.start()
+
+    def apply_async(self, func, arg, callback):
+        """Run func(arg) in a worker, and call callback with what it returns
+        (in another thread). Return a threading.Event that is set once the
+        callback has returned.
+        """
+        done = threading.Event()
+        with self._lock:
+            number = next(self._counter)
+            self._callbacks[number] = (callback, done)
+        self._tasks.put((number, func, arg))
+        return done
+
+    def imap_unordered(self, func, args):
+        """Yield func(arg) for each of these args, in the order they're
+        done. Only twice as many args as there are workers are taken ahead.
+        """
+        results = Queue.Queue()
+        args = iter(args)
+        pending = 0
+        for arg in islice(args, 2 * self._workers):
+            self.apply_async(func, arg, results.put)
+            pending += 1
+        while pending:
+            yield results.get()
+            pending -= 1
+            for arg in islice(args, 1):
+                self.apply_async(func, arg, results.put)
+                pending += 1
+
+    def close(self):
+        """Wait for the tasks to finish, then stop the workers."""
+        with self._lock:
+            processes = self._processes.values()
+        for _ in processes:
+            self._tasks.put(None)
+        for process in processes:
+            process.join()
+        self._results.put(None)
+        self._handler.join()
+
+    def terminate(self):
+        """Stop the workers now."""
+        self._tasks.cancel_join_thread()
+        with self._lock:
+            processes = self._processes.values()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+    def _start_worker(self):
+        process = multiprocessing.Process(
+            target=_pool_worker, args=self._worker_args
+        )
+        process.daemon = True
+        process.start()
+        with self._lock:
+            self._processes[process.pid] = process
+
+    def _handle_results(self):
+        """Pass each result to its callback and replace the workers that
+        stop, until close sends None.
+        """
+        while True:
+            item = self._results.get()
+            if item is None:
+                return
+            number, result, stopped = item
+            if stopped is not None:
+                with self._lock:
+                    process = self._processes.pop(stopped)
+                process.join()
+                self._start_worker()
+            with self._lock:
+                callback, done = self._callbacks.pop(number)
+            callback(result)
+            done.set()
+
+
+def solve_batch(
+    deals, heuristic='foundations', workers=None, with_stats=False,
+    cache_args=None, **options
+):
+    """Solve these deals (csv files or deal numbers) in a pool of worker
+    processes and yield a result dict for each deal as soon as it's done.
+
+    Each result has the "deal" and its "status" (a SearchResult status or
+    "error"). A search that ran gives the "seconds" it took. A solved deal
+    has its "moves" (as from move_to_dict). A search that ran out of its
+    budget has an "error" message and the "partial" moves towards the
+    solution that put the most cards on the foundations. options are
+    keyword arguments for solve (but not hdastar, since each deal is solved
+    in a single worker). workers defaults to the number of CPUs. If
+    with_stats, each result has the search's "stats" (from
+    SearchStats.to_dict). cache_args are the arguments for a SolutionCache
+    that each worker opens (or None).
+
+    A worker is replaced once it's using more than half of max_memory, or
+    _RECYCLE_MEGABYTES without one (see _WorkerPool).
+    """
+    jobs = ((deal, heuristic, options, with_stats) for deal in deals)
+    pool = _WorkerPool(
+        workers, cache_args, _recycle_megabytes(options.get('max_memory'))
+    )
+    try:
+        for result in pool.imap_unordered(_solve_deal, jobs):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+
+
+# The keys a service request may have besides its "id" and its deal
+_REQUEST_OPTIONS = (
+    'algorithm', 'heuristic', 'weight', 'width', 'table_size', 'symmetry',
+    'max_nodes', 'max_seconds', 'max_closed', 'max_memory', 'stats'
+)
+
+
+def _is_whole(value):
+    """Return whether this JSON value is a whole number."""
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def _is_number(value):
+    """Return whether this JSON value is a number."""
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+# Maps each request option to (what it must be, a function from a value to
+# whether it's one). The budgets may also be null for none.
+_REQUEST_OPTION_TYPES = {
+    'algorithm': ('a string', lambda value: isinstance(value, basestring)),
+    'heuristic': ('a string', lambda value: isinstance(value, basestring)),
+    'weight': ('a number', _is_number),
+    'width': ('a whole number', _is_whole),
+    'table_size': ('a whole number', _is_whole),
+    'symmetry': ('true or false', lambda value: isinstance(value, bool)),
+    'max_nodes': ('a whole number', _is_whole),
+    'max_seconds': ('a number', _is_number),
+    'max_closed': ('a whole number', _is_whole),
+    'max_memory': ('a number', _is_number),
+    'stats': ('true or false', lambda value: isinstance(value, bool)),
+}
+
+
+def _serve_request(job):
+    """Solve a service request in a worker and return its response. job
+    is a (request, defaults) pair. request is a dict (see serve), and
+    defaults is a dict of the options in _REQUEST_OPTIONS for those it
+    leaves out.
+    """
+    request, defaults = job
+    rtn = {}
+    if 'id' in request:
+        rtn['id'] = request['id']
+    options = dict(defaults)
+    try:
+        for name, value in request.iteritems():
+            if name in _REQUEST_OPTIONS:
+                kind, is_kind = _REQUEST_OPTION_TYPES[name]
+                if not is_kind(value) and \
+                 not (value is None and name.startswith('max_')):
+                    raise Exception('%s must be %s: %s' % (
+                        name, kind, json.dumps(value)
+                    ))
+                options[name] = value
+            elif name not in ('id', 'deal', 'rows'):
+                raise Exception('What option is this?: %s' % name)
+        if ('deal' in request) == ('rows' in request):
+            raise Exception('Give a deal or rows')
+        if 'deal' in request:
+            rtn['deal'] = request['deal']
+            if not _is_whole(request['deal']):
+                raise Exception(
+                    'A deal must be a whole number: %s' %
+                    json.dumps(request['deal'])
+                )
+            deal = FreeCellState.from_deal(request['deal'])
+        else:
+            deal = FreeCellState.from_rows(request['rows'])
+        heuristic = options.pop('heuristic')
+        if heuristic not in HEURISTICS:
+            raise Exception('What heuristic is this?: %s' % heuristic)
+        if options['algorithm'] == 'hdastar':
+            raise Exception('Each deal is solved in a single process')
+    except Exception as exc:
+        rtn['status'] = 'error'
+        rtn['error'] = str(exc)
+        return rtn
+    with_stats = options.pop('stats')
+    result = _solve_deal((deal, heuristic, options, with_stats))
+    del result['deal']
+    rtn.update(result)
+    return rtn
+
+
+def _serve_lines(lines, write, pool, defaults):
+    """Solve the JSON request on each of these lines in the pool, and call
+    write with each JSON response line as soon as it's ready. Return when
+    every response has been written.
+    """
+    lock = threading.Lock()
+    def respond(response):
+        with lock:
+            try:
+                write(json.dumps(response) + '\n')
+            except (IOError, OSError):
+                pass # The client went away
+    pending = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('A request is a JSON object')
+        except ValueError as exc:
+            respond({'status': 'error', 'error': str(exc)})
+            continue
+        pending.append(pool.apply_async(
+            _serve_request, (request, defaults), respond
+        ))
+    for done in pending:
+        done.wait()
+
+
+class _ServiceServer(
+    SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer
+):
+    daemon_threads = True
+
+
+def serve(defaults, workers=None, cache_args=None, socket_path=None):
+    """Run a solver service until stdin ends or Ctrl-C. It reads requests
+    as lines of JSON from stdin, or from each connection to a Unix socket
+    at socket_path, and writes a line of JSON for each response (in the
+    order they finish) back.
+
+    A request is an object with a "deal" number or the "rows" of a deal
+    (lists of card strings as in a csv file), and optionally an "id" to
+    send back and options from _REQUEST_OPTIONS. defaults has the options
+    it leaves out. The response is a result from solve_batch without the
+    rows.
+
+    Requests are solved concurrently by a _WorkerPool (of a worker per CPU
+    by default), whose workers are replaced once they're using more than
+    half of the default max_memory, or _RECYCLE_MEGABYTES without one.
+    cache_args are the arguments for a SolutionCache that each worker opens
+    (or None).
+    """
+    pool = _WorkerPool(
+        workers, cache_args, _recycle_megabytes(defaults.get('max_memory'))
+    )
+    try:
+        if socket_path is None:
+            def write(line):
+                sys.stdout.write(line)
+                sys.stdout.flush()
+            _serve_lines(iter(sys.stdin.readline, ''), write, pool, defaults)
+        else:
+            class Handler(SocketServer.StreamRequestHandler):
+                def handle(self):
+                    def write(line):
+                        self.wfile.write(line)
+                        self.wfile.flush()
+                    _serve_lines(
+                        iter(self.rfile.readline, ''), write, pool, defaults
+                    )
+            server = _ServiceServer(socket_path, Handler)
+            try:
+                server.serve_forever()
+            finally:
+                server.server_close()
+                os.remove(socket_path)
+        pool.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.terminate()
 
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename', help=(
+    parser.add_argument('filenames', nargs='*', metavar='filename', help=(
         'A csv file where each row represents a pile '
         'from top to bottom.'
         ' Each card is a two-character string (e.g. "3C").'
         ' Non-single-digit cards are one of these strings: '
         '"A", "T", "J", "Q", and "K". The suits are "H", '
         '"D", "C", and "S". All letters may be upper or '
-        'lower case.'
+        'lower case. With --batch, this may be several files '
+        'and directories of csv files.'
     ))
+    parser.add_argument(
+        '--serve', action='store_true',
+        help=(
+            'Run as a service that reads JSON requests, one per line, '
+            'from stdin (or --socket) and solves them in a pool of '
+            '--workers, writing a JSON result line for each. A request has '
+            'a "deal" number or the "rows" of a deal, an optional "id", '
+            'and optionally options that default to the ones given here: '
+            '%s.' % ', '.join('"%s"' % name for name in _REQUEST_OPTIONS)
+        )
+    )
+    parser.add_argument(
+        '--socket', metavar='PATH',
+        help='Serve requests on a Unix socket at this path.'
+    )
+    parser.add_argument(
+        '--deal', type=_deal_numbers, action='append', default=[],
+        help=(
+            'Solve the numbered deals (as in Microsoft FreeCell) in this '
+            'comma-separated list of numbers and ranges, e.g. "1..100". '
+            'May be given several times.'
+        )
+    )
+    parser.add_argument(
+        '--output', choices=('text', 'json'), default='text',
+        help='Print the moves as text (one per line) or as a JSON list.'
+    )
+    parser.add_argument(
+        '--heuristic', choices=sorted(HEURISTICS), default='foundations',
+        help='The heuristic to guide the search with.'
+    )
+    parser.add_argument(
+        '--pattern-db', metavar='FILENAME',
+        default=patterndb.DEFAULT_FILENAME,
+        help=(
+            'The pattern database for the "pattern" heuristic, built by '
+            'running patterndb.py.'
+        )
+    )
+    parser.add_argument(
+        '--weight', type=float, default=1,
+        help=(
+            'Multiply the heuristic by this. A weight above 1 finds '
+            'solutions faster, but they may not be the shortest.'
+        )
+    )
+    parser.add_argument(
+        '--algorithm', choices=ALGORITHMS, default='astar',
+        help=(
+            'The search algorithm. idastar (iterative-deepening A*) and '
+            'beam run in bounded memory. dfs tries the most promising '
+            'moves first and finds long solutions fast. external is A* '
+            'with its fringe and closed set in files (see --spill-dir). '
+            'hdastar is hash-distributed A* across --workers processes.'
+        )
+    )
+    parser.add_argument(
+        '--symmetry', action='store_true',
+        help=(
+            'Treat states that only differ by swapping H with D and C '
+            'with S as duplicates (astar only).'
+        )
+    )
+    parser.add_argument(
+        '--beam-width', type=int, default=1000,
+        help='The number of states beam keeps at each level.'
+    )
+    parser.add_argument(
+        '--table-size', type=int, default=100000,
+        help='The most states in the idastar transposition table.'
+    )
+    parser.add_argument(
+        '--spill-dir', metavar='DIRECTORY',
+        help=(
+            'Where external keeps its files (default: the temporary '
+            'directory). It should be on a fast local disk.'
+        )
+    )
+    parser.add_argument(
+        '--batch', action='store_true',
+        help=(
+            'Solve every deal in parallel and print a JSON result line '
+            'for each deal as it finishes.'
+        )
+    )
+    parser.add_argument(
+        '--workers', type=int,
+        help=(
+            'The number of worker processes for --batch, --serve or '
+            'hdastar (default: CPUs).'
+        )
+    )
+    parser.add_argument(
+        '--max-nodes', type=int,
+        help='Give up on a deal after expanding this many nodes.'
+    )
+    parser.add_argument(
+        '--max-seconds', type=float,
+        help='Give up on a deal after searching for this many seconds.'
+    )
+    parser.add_argument(
+        '--max-closed', type=int,
+        help='Give up on a deal after closing this many states.'
+    )
+    parser.add_argument(
+        '--max-memory', type=float,
+        help='Give up on a deal after using this many megabytes.'
+    )
+    parser.add_argument(
+        '--anytime', action='store_true',
+        help=(
+            'When giving up (or interrupted), print the moves that put '
+            'the most cards on the foundations.'
+        )
+    )
+    parser.add_argument(
+        '--stats', action='store_true',
+        help=(
+            "Print the search's stats as JSON to stderr (or in each result "
+            'with --batch).'
+        )
+    )
+    parser.add_argument(
+        '--cache', metavar='FILENAME',
+        help=(
+            'Look up solutions in this sqlite file before searching and '
+            'store the ones found.'
+        )
+    )
+    parser.add_argument(
+        '--cache-size', type=int, default=100000,
+        help='The most solutions to keep in the --cache.'
+    )
+    parser.add_argument(
+        '--checkpoint', metavar='FILENAME',
+        help=(
+            'Save the state of the search to this file every '
+            '--checkpoint-seconds and when it gives up or is interrupted '
+            '(astar only). It is removed when the search ends.'
+        )
+    )
+    parser.add_argument(
+        '--checkpoint-seconds', type=float, default=300,
+        help='How often to save a --checkpoint.'
+    )
+    parser.add_argument(
+        '--resume', action='store_true',
+        help=(
+            'Continue the search from the --checkpoint if it exists, with '
+            'the same deal, heuristic and options.'
+        )
+    )
+    parser.add_argument(
+        '--profile', action='store_true',
+        help='Run the search under cProfile and print the profile to stderr.'
+    )
     args = parser.parse_args()
 
+    options = {
+        'algorithm': args.algorithm,
+        'weight': args.weight,
+        'max_nodes': args.max_nodes,
+        'max_seconds': args.max_seconds,
+        'max_closed': args.max_closed,
+        'max_memory': args.max_memory,
+        'width': args.beam_width,
+        'table_size': args.table_size,
+        'symmetry': args.symmetry,
+        'spill_dir': args.spill_dir,
+    }
+    if args.socket is not None and not args.serve:
+        parser.error('--socket only works with --serve')
+    if args.heuristic == 'pattern' or args.serve:
+        # The service loads it if it's there, for requests that use it.
+        try:
+            load_pattern_db(args.pattern_db)
+        except Exception as exc:
+            if args.heuristic == 'pattern':
+                parser.error(str(exc))
+    if args.resume and args.checkpoint is None:
+        parser.error('--resume needs a --checkpoint')
+    if args.checkpoint is not None and (args.batch or args.serve):
+        parser.error('--checkpoint only works for a single deal')
+    if args.checkpoint is not None and args.algorithm != 'astar':
+        parser.error('--checkpoint only works with astar')
+    if args.serve:
+        if args.filenames or args.deal:
+            parser.error('--serve reads the deals from its requests')
+        if args.algorithm == 'hdastar':
+            parser.error('--serve solves each deal in a single process')
+        if args.profile:
+            parser.error("--profile doesn't work with --serve")
+        logging.basicConfig(level=logging.WARNING)
+        cache_args = None
+        if args.cache is not None:
+            cache_args = (args.cache, args.cache_size)
+        serve(
+            dict(options, heuristic=args.heuristic, stats=args.stats),
+            args.workers, cache_args, args.socket
+        )
+        return
+
+    # The deals come in parts: the list of files, then the xranges of deal
+    # numbers from each --deal.
+    parts = [_deal_files(args.filenames)]
+    for numbers in args.deal:
+        parts += numbers
+    num_deals = sum(len(part) for part in parts)
+    deals = chain.from_iterable(parts)
+    if not num_deals:
+        parser.error('Give a filename or --deal')
+    if args.symmetry and args.algorithm != 'astar':
+        parser.error('--symmetry only works with astar')
+    if args.batch:
+        if args.algorithm == 'hdastar':
+            parser.error('--batch solves each deal in a single process')
+        if args.profile:
+            parser.error("--profile doesn't work with --batch")
+        logging.basicConfig(level=logging.WARNING)
+        cache_args = None
+        if args.cache is not None:
+            cache_args = (args.cache, args.cache_size)
+        for result in solve_batch(
+            deals, args.heuristic, args.workers, args.stats, cache_args,
+            **options
+        ):
+            print json.dumps(result)
+            sys.stdout.flush()
+        return
+
+    if num_deals != 1:
+        parser.error('Only one deal is allowed without --batch')
     logging.basicConfig(level=logging.INFO)
-    freecell_prob = FreeCellProblem(args.filename)
-    for move in astar(freecell_prob):
-        print move
+    freecell_prob = FreeCellProblem(next(deals), args.heuristic)
+    # Ctrl-C cancels the search instead of killing it.
+    cancel = threading.Event()
+    signal.signal(signal.SIGINT, lambda signum, frame: cancel.set())
+    stats = SearchStats(log_stats) if args.stats else None
+    search = solve
+    if args.profile:
+        profile = cProfile.Profile()
+        search = lambda *pos, **kw: profile.runcall(solve, *pos, **kw)
+    cache = None
+    if args.cache is not None:
+        cache = SolutionCache(args.cache, args.cache_size)
+    result = SearchResult.of(
+        search, freecell_prob, workers=args.workers, cancel=cancel,
+        stats=stats, cache=cache, checkpoint=args.checkpoint,
+        checkpoint_seconds=args.checkpoint_seconds, resume=args.resume,
+        **options
+    )
+    if args.profile:
+        pstats.Stats(profile, stream=sys.stderr).sort_stats(
+            'cumulative'
+        ).print_stats(30)
+    if stats is not None:
+        sys.stderr.write(json.dumps(stats.to_dict(), sort_keys=True) + '\n')
+    if result.status in (SearchResult.SOLVED, SearchResult.UNSOLVABLE):
+        print format_solution(result.moves, args.output)
+        return
+    if args.anytime and result.moves is not None:
+        print format_solution(result.moves, args.output)
+    sys.exit('Gave up: %s' % result.reason)
 
 
 if __name__ == '__main__':
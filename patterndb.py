@@ -0,0 +1,209 @@
+#! /usr/bin/python2
+
+"""A pattern database for the FreeCell heuristic.
+
+The abstraction keeps the next WINDOW cards to go on the foundations of two
+suits and erases every other card. In a pile, only the order of the kept
+cards is left. In the abstract problem, a card may go on its foundation
+once the cards before it in its suit are there and no kept card is on top
+of it, and any card may be moved out of the way for one move, after which
+it never blocks another card. The database holds the fewest cards that
+have to be moved out of the way for each pattern, not counting the ones
+that are on top of a lower card of their suit, which have to be moved out
+of the way anyway (see FreeCellState.buried). Each card of a FreeCell move
+is moved in one of these problems at most, so the values for pairs of
+suits that don't share a suit add up, and they add to the buried cards.
+
+A pattern is given by the card under each kept card (see _index).
+The table is built once by running this module, and it's read through mmap,
+so it loads fast and its pages are shared by processes.
+"""
+
+import argparse
+import logging
+import mmap
+import struct
+
+WINDOW = 3
+NUM_CARDS = 2 * WINDOW
+
+# The kept cards are numbered with the WINDOW cards of the first suit in
+# order, then those of the second. In a pattern, each card has the number of
+# the kept card right under it in its pile, _BOTTOM if there's none, or
+# _LOOSE if it's in a free cell or there's no such card (after the king).
+_BOTTOM = NUM_CARDS
+_LOOSE = NUM_CARDS + 1
+_DIGIT_BITS = 3
+assert _LOOSE < 1 << _DIGIT_BITS
+NUM_PATTERNS = 1 << (_DIGIT_BITS * NUM_CARDS)
+
+_HEADER = struct.Struct('<6sB')
+_MAGIC = 'FCPDB1'
+
+DEFAULT_FILENAME = 'freecell.pdb'
+
+
+def _index(unders):
+    """Return the index in the table of the pattern where the card with
+    each number is on the card unders[number] (or is _BOTTOM or _LOOSE).
+    """
+    rtn = 0
+    for number, under in enumerate(unders):
+        rtn |= under << (_DIGIT_BITS * number)
+    return rtn
+
+
+def pattern_index(places):
+    """Return the index in the table of the pattern of these kept cards.
+    places[number] is the (pile, height) of the card with this number, or
+    None if it's in a free cell or there's no such card.
+    """
+    unders = [_LOOSE] * NUM_CARDS
+    last_pile = None
+    last_number = None
+    for (pile, _), number in sorted(
+        (place, number) for number, place in enumerate(places)
+        if place is not None
+    ):
+        unders[number] = last_number if pile == last_pile else _BOTTOM
+        last_pile = pile
+        last_number = number
+    return _index(unders)
+
+
+def _unders(index):
+    """Return the pattern with this index (the inverse of _index)."""
+    mask = (1 << _DIGIT_BITS) - 1
+    return [
+        (index >> (_DIGIT_BITS * number)) & mask
+        for number in xrange(NUM_CARDS)
+    ]
+
+
+def _belows(unders):
+    """Return a list of the sets of the cards below each card in its pile,
+    or None if the pattern is impossible.
+    """
+    on_top = set()
+    for under in unders:
+        if under < NUM_CARDS:
+            if under in on_top or unders[under] == _LOOSE:
+                return None
+            on_top.add(under)
+    rtn = []
+    for number in xrange(NUM_CARDS):
+        below = set()
+        under = unders[number]
+        while under < NUM_CARDS:
+            if under == number or under in below:
+                return None
+            below.add(under)
+            under = unders[under]
+        rtn.append(below)
+    return rtn
+
+
+def extra_moves(unders):
+    """Return the fewest cards that have to be moved out of the way to put
+    the cards of this pattern on their foundations, besides those on top of
+    a lower card of their suit, or None if the pattern is impossible.
+
+    A card has to be moved out of the way if a card under it goes on its
+    foundation first, so this finds the best order to put the two suits'
+    cards up in, by dynamic programming over how many of each are up.
+    """
+    belows = _belows(unders)
+    if belows is None:
+        return None
+    # A lower card of the same suit has a lower number.
+    buried = [
+        any(
+            other < number and (other < WINDOW) == (number < WINDOW)
+            for other in belows[number]
+        )
+        for number in xrange(NUM_CARDS)
+    ]
+    aboves = [
+        [
+            other for other in xrange(NUM_CARDS)
+            if number in belows[other] and not buried[other]
+        ]
+        for number in xrange(NUM_CARDS)
+    ]
+    # costs[first][second] is the fewest moves out of the way to put up the
+    # first cards of the first suit and the second cards of the second.
+    costs = [[None] * (WINDOW + 1) for _ in xrange(WINDOW + 1)]
+    costs[0][0] = 0
+    for first in xrange(WINDOW + 1):
+        for second in xrange(WINDOW + 1):
+            cost = costs[first][second]
+            if cost is None:
+                continue
+            up = set(range(first)) | set(range(WINDOW, WINDOW + second))
+            for next_first, next_second, card in (
+                (first + 1, second, first),
+                (first, second + 1, WINDOW + second)
+            ):
+                if next_first > WINDOW or next_second > WINDOW:
+                    continue
+                # The cards above it that are still in the way
+                moved = sum(
+                    1 for other in aboves[card]
+                    if other not in up and not belows[other] & up
+                )
+                old = costs[next_first][next_second]
+                if old is None or cost + moved < old:
+                    costs[next_first][next_second] = cost + moved
+    return costs[WINDOW][WINDOW]
+
+
+def build(filename):
+    """Compute the table and write it to this file."""
+    table = bytearray(NUM_PATTERNS)
+    for index in xrange(NUM_PATTERNS):
+        value = extra_moves(_unders(index))
+        if value is not None:
+            table[index] = value
+    with open(filename, 'wb') as file_obj:
+        file_obj.write(_HEADER.pack(_MAGIC, WINDOW))
+        file_obj.write(table)
+
+
+class PatternDatabase(object):
+    """A table built by build, read through mmap."""
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as file_obj:
+            self._data = mmap.mmap(
+                file_obj.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        if len(self._data) != _HEADER.size + NUM_PATTERNS or \
+         _HEADER.unpack_from(self._data) != (_MAGIC, WINDOW):
+            self._data.close()
+            raise Exception('%s is not a pattern database' % filename)
+
+    def extra_moves(self, index):
+        """Return extra_moves for the pattern with this index."""
+        return ord(self._data[_HEADER.size + index])
+
+    def close(self):
+        self._data.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=(
+        'Build the pattern database for the "pattern" heuristic.'
+    ))
+    parser.add_argument(
+        'filename', nargs='?', default=DEFAULT_FILENAME,
+        help='The file to write it to.'
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    logging.info('Building %s patterns' % NUM_PATTERNS)
+    build(args.filename)
+    logging.info('Wrote %s' % args.filename)
+
+
+if __name__ == '__main__':
+    main()
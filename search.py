@@ -1,43 +1,265 @@
 """Module for search algorithms"""
 
-from Queue import PriorityQueue
-from logging import info
+from array import array
+import cPickle
+from heapq import heappush, heappop, merge, nsmallest
+from itertools import count, izip
+from logging import info, warning
+import mmap
+from multiprocessing import Process, Queue, cpu_count
+import os
+import shutil
+from signal import SIGINT, SIG_IGN, signal
+import struct
+import sys
+import tempfile
 from time import time
+from traceback import format_exc
 
-class _Node:
-    """Represents a node in the search problem."""
+try:
+    import resource
+except ImportError: # Not on Unix
+    resource = None
 
-    def __init__(
-        self, state, problem, parent_node=None, move=None, cost=1
-    ):
-        """Initialize a new node.
+class SearchLimitExceeded(Exception):
+    """Raised when a search runs out of its budget: it expands too many
+    nodes, takes too long, closes too many states or uses too much memory.
+    partial is the list of moves to the state with the most progress the
+    search expanded (or None).
+    """
+
+    def __init__(self, message, partial=None):
+        Exception.__init__(self, message)
+        self.partial = partial
+
+
+class SearchCancelled(SearchLimitExceeded):
+    """Raised when a search is cancelled."""
+
+
+class SearchResult(object):
+    """The outcome of a search.
+
+    status is SOLVED, UNSOLVABLE, BUDGET_EXCEEDED or CANCELLED. moves is
+    the solution if it's solved, else the best partial line (or None).
+    reason says which budget ran out. seconds is how long the search took.
+    """
+
+    SOLVED = 'solved'
+    UNSOLVABLE = 'unsolvable'
+    BUDGET_EXCEEDED = 'budget_exceeded'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, status, moves=None, reason=None, seconds=None):
+        self.status = status
+        self.moves = moves
+        self.reason = reason
+        self.seconds = seconds
+
+    @classmethod
+    def of(cls, search, *args, **kwargs):
+        """Run search(*args, **kwargs) and return its SearchResult."""
+        start = time()
+        try:
+            moves = search(*args, **kwargs)
+        except SearchLimitExceeded as exc:
+            if isinstance(exc, SearchCancelled):
+                status = cls.CANCELLED
+            else:
+                status = cls.BUDGET_EXCEEDED
+            return cls(status, exc.partial, str(exc), time() - start)
+        if moves is None:
+            return cls(cls.UNSOLVABLE, seconds=time() - start)
+        return cls(cls.SOLVED, moves, seconds=time() - start)
+
+    def __repr__(self):
+        return 'SearchResult(%r, %s moves)' % (
+            self.status, None if self.moves is None else len(self.moves)
+        )
+
+
+class SearchStats(object):
+    """Counters describing a search, filled in as it runs.
 
-        The parent node is the node that generates this state.
-        Use None if this is the root node.
-        move is the move that is done to go from the parent_node
-        to this node (this is only to be displayed).
+    expanded is the number of nodes expanded. generated is the number of
+    successors made. duplicates is the number of successors dropped because
+    their state was already reached as cheaply. symmetric_duplicates is the
+    number of states dropped because a different but symmetric state was
+    closed (see astar's symmetry). fringe_size and
+    closed_size are the number of states waiting to be expanded and closed
+    at the last check. move_counts maps a move kind (from
+    Problem.move_kind) to the number of such moves generated.
+    heuristic_seconds and successor_seconds are the time spent in
+    Problem.heuristic and Problem.next_states. peak_memory is the peak
+    resident memory of the search's processes in megabytes, as sampled
+    while it runs. seconds is how long the
+    search ran and solution_length is the number of moves in the solution
+    (or None).
+
+    Counting generated nodes, moves and time slows the search down a bit,
+    so it's done only for a search that's given a SearchStats. If callback
+    isn't None, it's called with this object about once a second and when
+    the search ends.
+    """
+
+    _COUNTERS = (
+        'expanded', 'generated', 'duplicates', 'symmetric_duplicates',
+        'fringe_size', 'closed_size',
+        'heuristic_seconds', 'successor_seconds', 'peak_memory'
+    )
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.expanded = 0
+        self.generated = 0
+        self.duplicates = 0
+        self.symmetric_duplicates = 0
+        self.fringe_size = 0
+        self.closed_size = 0
+        self.move_counts = {}
+        self.heuristic_seconds = 0.0
+        self.successor_seconds = 0.0
+        self.peak_memory = None
+        self.seconds = 0.0
+        self.solution_length = None
+
+    def branching_factor(self):
+        """Return the mean number of successors of an expanded node."""
+        if not self.expanded:
+            return None
+        return float(self.generated) / self.expanded
+
+    def effective_branching_factor(self):
+        """Return b such that a uniform tree as deep as the solution with b
+        children per node has as many nodes as were generated (or None if
+        there's no solution to measure it by).
         """
-        self._state = state
-        self._parent = parent_node
-        self._move = move
-        self._problem = problem
-        if parent_node is None:
-            self._step_cost = 0
-        else:
-            self._step_cost = parent_node._step_cost + cost
+        depth = self.solution_length
+        if not depth or not self.generated:
+            return None
+        def tree_size(branching):
+            return sum(branching ** level for level in xrange(1, depth + 1))
+        # tree_size(high) >= generated, and it doesn't overflow for deep
+        # solutions.
+        low, high = 0.0, max(1.0, float(self.generated) ** (1.0 / depth))
+        while high - low > 1e-6:
+            middle = (low + high) / 2
+            if tree_size(middle) < self.generated:
+                low = middle
+            else:
+                high = middle
+        return low
+
+    def combine(self, others):
+        """Set the counters to the sums of these dicts (from to_dict), which
+        describe the parts of a search run in other processes.
+        """
+        for name in self._COUNTERS:
+            values = [
+                other[name] for other in others if other[name] is not None
+            ]
+            setattr(self, name, sum(values) if values else None)
+        self.move_counts = {}
+        for other in others:
+            for kind, num in other['move_counts'].iteritems():
+                self.move_counts[kind] = self.move_counts.get(kind, 0) + num
+
+    def to_dict(self):
+        """Return the stats as a dict that can be dumped as JSON."""
+        rtn = dict((name, getattr(self, name)) for name in self._COUNTERS)
+        rtn['move_counts'] = dict(self.move_counts)
+        rtn['seconds'] = self.seconds
+        rtn['solution_length'] = self.solution_length
+        rtn['branching_factor'] = self.branching_factor()
+        rtn['effective_branching_factor'] = self.effective_branching_factor()
+        return rtn
+
+
+def log_stats(stats):
+    """A SearchStats callback that logs the progress of the search."""
+    info('%s nodes, %s in the fringe, %s closed' % (
+        stats.expanded, stats.fringe_size, stats.closed_size
+    ))
+
+
+def _rss_megabytes():
+    """Return the resident memory of this process in megabytes, or None if
+    it can't be measured. It's read from /proc where there is one (Linux).
+    Elsewhere it's the peak over the life of the process, which is all
+    getrusage gives (in kilobytes, but in bytes on macOS).
+    """
+    try:
+        with open('/proc/self/statm') as file_obj:
+            pages = int(file_obj.read().split()[1])
+        return pages * mmap.PAGESIZE / 1048576.0
+    except IOError:
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            return peak / 1048576.0
+        return peak / 1024.0
+
+
+class _NodeStore(object):
+    """Stores the nodes of a search tree in parallel arrays.
+
+    A node is an integer id. The store holds the id of the node's parent
+    (-1 for the root), the step cost from the root, and the move done to go
+    from the parent to the node (this is only to be displayed).
+    """
+
+    __slots__ = ('_parents', '_step_costs', '_moves')
+
+    def __init__(self):
+        self._parents = array('l')
+        self._step_costs = array('l')
+        self._moves = []
+
+    def add(self, parent=-1, move=None, step_cost=0):
+        """Add a node and return its id."""
+        self._parents.append(parent)
+        self._step_costs.append(step_cost)
+        self._moves.append(move)
+        return len(self._moves) - 1
+
+    def step_cost(self, node):
+        """Return the cost of the moves from the root to this node."""
+        return self._step_costs[node]
+
+    def parent(self, node):
+        """Return the id of this node's parent (-1 for the root)."""
+        return self._parents[node]
 
-    def get_state(self):
-        return self._state
+    def move(self, node):
+        """Return the move to get to this node from its parent."""
+        return self._moves[node]
 
-    def get_parent(self):
-        return self._parent
+    def move_seq(self, node):
+        """Return the list of moves to get to this node."""
+        rtn = []
+        parents = self._parents
+        while parents[node] != -1:
+            rtn.append(self._moves[node])
+            node = parents[node]
+        return list(reversed(rtn))
 
-    def get_move(self):
-        return self._move
+    def __len__(self):
+        return len(self._moves)
 
-    def get_cost(self):
-        """Return the total cost (step + heuristic)."""
-        return self._step_cost + self._problem.heuristic(self._state)
+    def __getstate__(self):
+        # Arrays pickle as lists of ints, so they're pickled as bytes.
+        return (
+            self._parents.tostring(), self._step_costs.tostring(),
+            self._moves
+        )
+
+    def __setstate__(self, state):
+        parents, step_costs, self._moves = state
+        self._parents = array('l')
+        self._parents.fromstring(parents)
+        self._step_costs = array('l')
+        self._step_costs.fromstring(step_costs)
 
 
 class Problem:
@@ -61,27 +283,222 @@ class Problem:
         """
         raise NotImplementedError
 
+    def iter_next_states(self, state):
+        """Return an iterator of the (state, move, cost) tuples of
+        next_states, the most promising first. A subclass may override this
+        to make each state only when it's asked for.
+        """
+        return iter(self.next_states(state))
+
     def heuristic(self, state):
         """Return a heuristic. A subclass may override this to use with A
         star.
         """
         return 0
 
+    def heuristic_name(self):
+        """Return a name for the heuristic, which a checkpoint records so
+        that the search is only resumed with the same heuristic. A subclass
+        should override this if it overrides heuristic.
+        """
+        return None
+
+    def heuristic_batch(self, states):
+        """Return the list of the heuristics of these states. The layered
+        searches (beam and external_astar) score their successors in
+        batches with this. A subclass may override this to score a batch
+        faster than one state at a time.
+        """
+        return [self.heuristic(state) for state in states]
+
+    def progress(self, state):
+        """Return how far along this state is towards a goal (higher is
+        further). When a search runs out of its budget, it gives the moves
+        to the state with the most progress. A subclass may override this.
+        """
+        return 0
+
+    def move_kind(self, move):
+        """Return the kind of this move, for SearchStats.move_counts, or
+        None to leave it out. A subclass may override this.
+        """
+        return None
+
+    def symmetry_key(self, state):
+        """Return a key (hashable) that is the same for states that are
+        equivalent under a symmetry of the problem: their solutions are the
+        same moves relabeled, and they have the same heuristic. A subclass
+        may override this. By default, every state is its own key.
+        """
+        return state
+
+    def encode_state(self, state):
+        """Return a string encoding this state, which is the same for equal
+        states and different for unequal states. A subclass must override
+        this to use external_astar.
+        """
+        raise NotImplementedError
+
+    def decode_state(self, encoded):
+        """Return the state from encode_state. A subclass must override this
+        to use external_astar.
+        """
+        raise NotImplementedError
+
+    def encode_moves(self, moves):
+        """Return a string encoding this list of moves. It must be the
+        encodings of each of the moves one after another. A subclass must
+        override this to use external_astar.
+        """
+        raise NotImplementedError
+
+    def decode_moves(self, encoded):
+        """Return the list of moves from encode_moves. A subclass must
+        override this to use external_astar.
+        """
+        raise NotImplementedError
+
+
+class _InstrumentedProblem(Problem):
+    """Wraps a problem to count and time its successors and heuristic in a
+    SearchStats.
+    """
+
+    def __init__(self, problem, stats):
+        self._problem = problem
+        self._stats = stats
+
+    def initial_state(self):
+        return self._problem.initial_state()
+
+    def is_goal(self, state):
+        return self._problem.is_goal(state)
+
+    def next_states(self, state):
+        stats = self._stats
+        start = time()
+        rtn = self._problem.next_states(state)
+        stats.successor_seconds += time() - start
+        stats.generated += len(rtn)
+        move_counts = stats.move_counts
+        move_kind = self._problem.move_kind
+        for _, move, _ in rtn:
+            kind = move_kind(move)
+            if kind is not None:
+                move_counts[kind] = move_counts.get(kind, 0) + 1
+        return rtn
+
+    def iter_next_states(self, state):
+        stats = self._stats
+        move_counts = stats.move_counts
+        move_kind = self._problem.move_kind
+        successors = self._problem.iter_next_states(state)
+        while True:
+            start = time()
+            try:
+                successor = next(successors)
+            except StopIteration:
+                return
+            finally:
+                stats.successor_seconds += time() - start
+            stats.generated += 1
+            kind = move_kind(successor[1])
+            if kind is not None:
+                move_counts[kind] = move_counts.get(kind, 0) + 1
+            yield successor
+
+    def heuristic(self, state):
+        start = time()
+        rtn = self._problem.heuristic(state)
+        self._stats.heuristic_seconds += time() - start
+        return rtn
+
+    def heuristic_name(self):
+        return self._problem.heuristic_name()
+
+    def heuristic_batch(self, states):
+        start = time()
+        rtn = self._problem.heuristic_batch(states)
+        self._stats.heuristic_seconds += time() - start
+        return rtn
+
+    def progress(self, state):
+        return self._problem.progress(state)
+
+    def move_kind(self, move):
+        return self._problem.move_kind(move)
+
+    def symmetry_key(self, state):
+        return self._problem.symmetry_key(state)
+
+    def encode_state(self, state):
+        return self._problem.encode_state(state)
+
+    def decode_state(self, encoded):
+        return self._problem.decode_state(encoded)
+
+    def encode_moves(self, moves):
+        return self._problem.encode_moves(moves)
+
+    def decode_moves(self, encoded):
+        return self._problem.decode_moves(encoded)
+
+
+class _SymmetricSet(object):
+    """A set of states that contains every state with the same
+    Problem.symmetry_key as a state added. States found only by symmetry
+    are counted in stats.symmetric_duplicates.
+    """
+
+    __slots__ = ('_symmetry_key', '_states', '_stats')
+
+    def __init__(self, symmetry_key, stats):
+        self._symmetry_key = symmetry_key
+        self._states = {} # Maps a key to the state added with it
+        self._stats = stats
+
+    def add(self, state):
+        self._states[self._symmetry_key(state)] = state
+
+    def __contains__(self, state):
+        added = self._states.get(self._symmetry_key(state))
+        if added is None:
+            return False
+        if added != state:
+            self._stats.symmetric_duplicates += 1
+        return True
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return self._states.itervalues()
+
 
 class _Fringe:
-    """Represents a fringe."""
+    """Represents a fringe of (state, node) pairs, where node is a
+    _NodeStore id.
+    """
 
     def __init__(self):
         """Return a new fringe."""
         raise NotImplementedError
 
-    def push(self, node):
-        """Push a node onto this fringe."""
+    def accepts(self, state, step_cost):
+        """Return whether a push of this state with this step cost would be
+        kept.
+        """
+        return True
+
+    def push(self, state, node, step_cost, cost):
+        """Push a state onto this fringe. cost is the total cost (step +
+        heuristic).
+        """
         raise NotImplementedError
 
     def pop(self):
-        """Remove and return a node from this fringe. If there is nothing
-        to remove, raise an Exception.
+        """Remove and return a (state, node) pair from this fringe. If there
+        is nothing to remove, raise an Exception.
         """
         raise NotImplementedError
 
@@ -91,67 +508,1182 @@ class _Fringe:
 
 
 class _PriorityQueue(_Fringe):
-    """A priority queue for a-star."""
+    """A priority queue for a-star.
 
-    def __init__(self):
-        self._queue = PriorityQueue()
+    States with the lowest cost come out first. Ties go to the deeper node,
+    then to the node that was pushed first. Only the node with the lowest
+    step cost is kept for each state, or for each key if key (a function
+    from a state to a hashable key) isn't None. The others are skipped when
+    they reach the top of the heap.
+    """
 
-    def push(self, node):
-        self._queue.put((node.get_cost(), node))
+    def __init__(self, key=None):
+        self._heap = []
+        self._counter = count()
+        self._key = key
+        self._best_step_cost = {} # Maps a key to its cheapest node's cost
+
+    def accepts(self, state, step_cost):
+        if self._key is not None:
+            state = self._key(state)
+        best = self._best_step_cost.get(state)
+        return best is None or step_cost < best
+
+    def push(self, state, node, step_cost, cost):
+        if not self.accepts(state, step_cost):
+            return
+        key = state if self._key is None else self._key(state)
+        self._best_step_cost[key] = step_cost
+        heappush(
+            self._heap,
+            (cost, -step_cost, next(self._counter), node, state)
+        )
 
     def pop(self):
-        return self._queue.get(False)[1]
+        self._discard_stale()
+        _, _, _, node, state = heappop(self._heap)
+        del self._best_step_cost[
+            state if self._key is None else self._key(state)
+        ]
+        return state, node
 
     def is_empty(self):
-        return self._queue.empty()
+        self._discard_stale()
+        return not self._heap
 
+    def __len__(self):
+        """Return the number of states in this fringe."""
+        return len(self._best_step_cost)
 
-def _move_seq(node):
-    """Return the list of moves to get to this _Node."""
-    rtn = []
-    while node.get_parent() is not None:
-        rtn.append(node.get_move())
-        node = node.get_parent()
-    return list(reversed(rtn))
+    def snapshot(self):
+        """Return the contents of this fringe, which can be pickled."""
+        return self._heap, self._best_step_cost, next(self._counter)
 
+    def restore(self, snapshot):
+        """Replace the contents of this fringe with a snapshot."""
+        self._heap, self._best_step_cost, first = snapshot
+        self._counter = count(first)
 
-def _search(problem, fringe_cls):
-    """Return a sequence of moves that goes towards the solution.
-    If no solution exists, return None.
+    def min_cost(self):
+        """Return the lowest cost in this fringe or None if it's empty."""
+        if self.is_empty():
+            return None
+        return self._heap[0][0]
+
+    def _discard_stale(self):
+        """Pop entries off the heap until the top entry is the cheapest for
+        its state.
+        """
+        heap = self._heap
+        best_step_cost = self._best_step_cost
+        key = self._key
+        while heap:
+            _, neg_step_cost, _, _, state = heap[0]
+            if key is not None:
+                state = key(state)
+            if best_step_cost.get(state) == -neg_step_cost:
+                return
+            heappop(heap)
+
+
+class _Limits(object):
+    """Counts expanded nodes, enforces a search's budget and reports its
+    stats.
+
+    SearchLimitExceeded is raised when there are more than max_nodes
+    expanded nodes, the search has run for more than max_seconds, there are
+    more than max_closed closed states or the process is using more than
+    max_memory megabytes (if they aren't None). SearchCancelled is raised
+    once cancel (an object like threading.Event) is set. Memory and cancel
+    are checked every _CHECK_INTERVAL nodes.
+
+    stats is the SearchStats to fill in. Without one, the progress is
+    logged once a second.
     """
-    closed = set()
-    fringe = fringe_cls()
-    fringe.push(_Node(problem.initial_state(), problem))
-    nodes_popped = 0
-    last_nodes_popped = 0
-    last_second = int(time())
 
-    while True:
-        if fringe.is_empty():
-            return None
+    _CHECK_INTERVAL = 256
 
-        node = fringe.pop()
-        nodes_popped += 1
+    def __init__(
+        self, max_nodes=None, max_seconds=None, max_closed=None,
+        max_memory=None, cancel=None, stats=None
+    ):
+        self._max_nodes = max_nodes
+        self._max_seconds = max_seconds
+        self._max_closed = max_closed
+        self._max_memory = max_memory
+        self._cancel = cancel
+        self._peak_memory = None
+        self._start = time()
+        self._last_second = int(self._start)
+        if stats is None:
+            stats = SearchStats(log_stats)
+        self.stats = stats
+
+    def expand(self, num_closed=0, num_fringe=0):
+        """Count an expanded node. num_closed and num_fringe are the number
+        of states the search is keeping closed and waiting to be expanded.
+        If the node would be over the budget, raise before counting it.
+        """
+        stats = self.stats
+        stats.closed_size = num_closed
+        stats.fringe_size = num_fringe
+        self.check(
+            stats.expanded + 1, num_closed,
+            (stats.expanded + 1) % self._CHECK_INTERVAL == 0
+        )
+        stats.expanded += 1
+        self.tick()
+
+    def tick(self, memory=0):
+        """Report the stats if a new second has started since the last
+        report. memory is the megabytes used by other processes.
+        """
         crnt_second = int(time())
-        if crnt_second > last_second:
-            info('%s nodes (+%s nodes)' % (nodes_popped, nodes_popped - last_nodes_popped))
-            last_second = crnt_second
-            last_nodes_popped = nodes_popped
-        state = node.get_state()
-        if problem.is_goal(state):
-            return _move_seq(node)
-
-        if state not in closed:
+        if crnt_second > self._last_second:
+            self._last_second = crnt_second
+            self.report(memory)
+
+    def check(self, nodes_popped, num_closed, slow=True, memory=0):
+        """Raise SearchLimitExceeded if the search is over its budget.
+        Memory and cancel are only checked if slow. memory is the megabytes
+        used by other processes.
+        """
+        if self._max_nodes is not None and nodes_popped > self._max_nodes:
+            raise SearchLimitExceeded('Expanded %s nodes' % self._max_nodes)
+        if self._max_seconds is not None and \
+         time() - self._start > self._max_seconds:
+            raise SearchLimitExceeded(
+                'Searched for %s seconds' % self._max_seconds
+            )
+        if self._max_closed is not None and num_closed > self._max_closed:
+            raise SearchLimitExceeded('Closed %s states' % self._max_closed)
+        if not slow:
+            return
+        if self._max_memory is not None:
+            used = self._measure(memory)
+            if used is None:
+                raise Exception('Measuring memory needs /proc or resource')
+            if used > self._max_memory:
+                raise SearchLimitExceeded('Used %s MB' % self._max_memory)
+        if self._cancel is not None and self._cancel.is_set():
+            raise SearchCancelled('Cancelled')
+
+    def report(self, memory=0):
+        """Update the time and memory in the stats and pass them to its
+        callback. memory is the megabytes used by other processes.
+        """
+        stats = self.stats
+        stats.seconds = time() - self._start
+        self._measure(memory)
+        stats.peak_memory = self._peak_memory
+        if stats.callback is not None:
+            stats.callback(stats)
+
+    def _measure(self, memory):
+        """Return memory plus the megabytes this process is using now (or
+        None if that can't be measured), keeping the peak.
+        """
+        rss = _rss_megabytes()
+        if rss is None:
+            return None
+        rtn = memory + rss
+        if self._peak_memory is None or rtn > self._peak_memory:
+            self._peak_memory = rtn
+        return rtn
+
+    def finish(self, moves, memory=0):
+        """Report the stats of a search that's ending with these moves (a
+        solution or None) and return the moves.
+        """
+        if moves is not None:
+            self.stats.solution_length = len(moves)
+        self.report(memory)
+        return moves
+
+
+class _Checkpoints(object):
+    """Saves the state of a search to a file every so often, so that it can
+    resume from there if it's stopped.
+
+    Where there's os.fork, a checkpoint is written by a child process with
+    a copy-on-write snapshot of the search, so the search only pauses to
+    fork. A checkpoint is skipped if the last one is still being written.
+    The file is written under a temporary name and then renamed, so it
+    always holds a whole checkpoint.
+    """
+
+    def __init__(self, filename, seconds):
+        self._filename = filename
+        self._seconds = seconds
+        self._last_save = time()
+        self._child = None
+
+    def load(self):
+        """Return the saved object, or None if there's no checkpoint."""
+        if not os.path.exists(self._filename):
+            return None
+        info('Resuming from %s' % self._filename)
+        with open(self._filename, 'rb') as file_obj:
+            return cPickle.load(file_obj)
+
+    def due(self):
+        """Return whether it's time to save a checkpoint."""
+        return time() - self._last_save >= self._seconds
+
+    def save(self, snapshot, background=True):
+        """Save the object snapshot() returns, in the background if
+        possible.
+        """
+        self._last_save = time()
+        if not background or not hasattr(os, 'fork'):
+            self.wait()
+            self._write(snapshot())
+            return
+        if self._child is not None:
+            pid, status = os.waitpid(self._child, os.WNOHANG)
+            if pid == 0:
+                return
+            self._check(status)
+        self._child = os.fork()
+        if self._child == 0:
+            status = 1
+            try:
+                self._write(snapshot())
+                status = 0
+            finally:
+                os._exit(status)
+
+    def _write(self, obj):
+        temp_filename = self._filename + '.tmp'
+        with open(temp_filename, 'wb') as file_obj:
+            cPickle.dump(obj, file_obj, cPickle.HIGHEST_PROTOCOL)
+            file_obj.flush()
+            os.fsync(file_obj.fileno())
+        os.rename(temp_filename, self._filename)
+
+    def _check(self, status):
+        if status != 0:
+            warning('Writing a checkpoint to %s failed' % self._filename)
+
+    def wait(self):
+        """Wait for a checkpoint being written in the background."""
+        if self._child is not None:
+            self._check(os.waitpid(self._child, 0)[1])
+            self._child = None
+
+    def remove(self):
+        """Remove the checkpoint, once the search is done."""
+        self.wait()
+        if os.path.exists(self._filename):
+            os.remove(self._filename)
+
+
+def _instrument(problem, stats, budget):
+    """Return the (problem, _Limits) for a search with this SearchStats (or
+    None) and budget. The problem is wrapped to count and time its
+    successors and heuristic if there are stats.
+    """
+    if stats is not None:
+        problem = _InstrumentedProblem(problem, stats)
+    return problem, _Limits(stats=stats, **budget)
+
+
+def _search(
+    problem, fringe_cls, weight=1, stats=None, symmetry=False,
+    checkpoint=None, checkpoint_seconds=300, resume=False, **budget
+):
+    """Return a sequence of moves that goes towards the solution.
+    If no solution exists, return None. The heuristic is multiplied by
+    weight. If symmetry, states with the same Problem.symmetry_key are
+    treated as duplicates. checkpoint, checkpoint_seconds and resume are
+    as for astar.
+    """
+    problem, limits = _instrument(problem, stats, budget)
+    stats = limits.stats
+    nodes = _NodeStore()
+    if symmetry:
+        closed = _SymmetricSet(problem.symmetry_key, stats)
+        fringe = fringe_cls(problem.symmetry_key)
+    else:
+        closed = set()
+        fringe = fringe_cls()
+    init_state = problem.initial_state()
+    best_progress = None
+    best_node = None
+    checkpoints = None
+    saved = None
+    if checkpoint is not None:
+        checkpoints = _Checkpoints(checkpoint, checkpoint_seconds)
+        if resume:
+            saved = checkpoints.load()
+    # What a checkpoint must be of for this search to resume from it
+    search = (init_state, problem.heuristic_name(), weight, symmetry)
+    if saved is None:
+        fringe.push(
+            init_state, nodes.add(), 0, weight * problem.heuristic(init_state)
+        )
+    else:
+        if saved['search'] != search:
+            raise Exception(
+                '%s is a checkpoint of another search (a different deal, '
+                'heuristic, weight or symmetry)' % checkpoint
+            )
+        nodes = saved['nodes']
+        fringe.restore(saved['fringe'])
+        for state in saved['closed']:
             closed.add(state)
-            for next_state, move, cost in problem.next_states(state):
-                fringe.push(_Node(
-                    next_state, problem, parent_node=node, move=move, cost=cost
-                ))
+        best_progress, best_node = saved['best']
+        stats.combine([saved['stats']])
+
+    def snapshot():
+        return {
+            'search': search,
+            'nodes': nodes,
+            'fringe': fringe.snapshot(),
+            'closed': list(closed),
+            'best': (best_progress, best_node),
+            'stats': stats.to_dict(),
+        }
+
+    def finish(moves):
+        if checkpoints is not None:
+            checkpoints.remove()
+        return limits.finish(moves)
+
+    try:
+        while True:
+            if fringe.is_empty():
+                return finish(None)
 
+            if checkpoints is not None and checkpoints.due():
+                checkpoints.save(snapshot)
+            # This raises SearchLimitExceeded before the state is popped,
+            # so the last checkpoint has it.
+            limits.expand(len(closed), len(fringe))
+            state, node = fringe.pop()
+            if problem.is_goal(state):
+                return finish(nodes.move_seq(node))
 
-def astar(problem):
+            if state not in closed:
+                closed.add(state)
+                progress = problem.progress(state)
+                if best_progress is None or progress > best_progress:
+                    best_progress = progress
+                    best_node = node
+                step_cost = nodes.step_cost(node)
+                for next_state, move, cost in problem.next_states(state):
+                    next_step_cost = step_cost + cost
+                    if next_state in closed or \
+                     not fringe.accepts(next_state, next_step_cost):
+                        stats.duplicates += 1
+                        continue
+                    fringe.push(
+                        next_state,
+                        nodes.add(node, move, next_step_cost),
+                        next_step_cost,
+                        next_step_cost + weight * problem.heuristic(next_state)
+                    )
+    except SearchLimitExceeded as exc:
+        if best_node is not None:
+            exc.partial = nodes.move_seq(best_node)
+        if checkpoints is not None:
+            checkpoints.save(snapshot, background=False)
+        limits.finish(None)
+        raise
+
+
+def astar(
+    problem, weight=1, stats=None, symmetry=False, checkpoint=None,
+    checkpoint_seconds=300, resume=False, **budget
+):
     """Return a sequence of moves that goes towards the solution.
     If no solution exists, return None.
+
+    With a weight above 1, this is weighted A*: nodes are ordered by the
+    step cost plus weight times the heuristic. Solutions are found faster
+    but may cost up to weight times the optimal cost.
+
+    budget is keyword arguments for _Limits (max_nodes, max_seconds,
+    max_closed, max_memory and cancel). Raise SearchLimitExceeded, with the
+    moves to the expanded state with the most progress, when it runs out.
+
+    stats is a SearchStats to fill in (or None).
+
+    If symmetry, a state is a duplicate of any state with the same
+    Problem.symmetry_key, so only one of a set of symmetric subtrees is
+    searched. The costs stay optimal as long as the heuristic gives
+    symmetric states the same value.
+
+    If checkpoint is a filename, the whole state of the search is saved
+    there every checkpoint_seconds (see _Checkpoints) and when it runs out
+    of its budget, and the file is removed when the search ends. If resume,
+    the search continues from the checkpoint if there is one. The problem
+    must be the same, and its states and moves must be picklable.
+    """
+    return _search(
+        problem, _PriorityQueue, weight, stats, symmetry, checkpoint,
+        checkpoint_seconds, resume, **budget
+    )
+
+
+def idastar(problem, weight=1, table_size=100000, stats=None, **budget):
+    """Return a sequence of moves that goes towards the solution using
+    iterative-deepening A*. If no solution exists, return None.
+
+    Each iteration is a depth-first search that cuts off nodes costing
+    more than the threshold (step cost plus weight times the heuristic),
+    starting at the cost of the initial state and rising to the lowest
+    cost cut off by the last iteration. Memory is bounded by the depth of
+    the search and a transposition table of at most table_size states,
+    which skips states already reached as cheaply in this iteration. The
+    table is cleared when it's full.
+
+    budget and stats are as for astar. The states in the table count as
+    closed and the path counts as the fringe.
+    """
+    problem, limits = _instrument(problem, stats, budget)
+    stats = limits.stats
+    init_state = problem.initial_state()
+    threshold = weight * problem.heuristic(init_state)
+    best_progress = None
+    best_moves = None
+    try:
+        while True:
+            table = {}
+            next_threshold = None
+            # Each entry is (state, step cost, move, iterator of children
+            # (cost, step cost, state, move)).
+            path = set([init_state])
+            stack = [(init_state, 0, None, None)]
+            while stack:
+                state, step_cost, move, children = stack[-1]
+                if children is None:
+                    if problem.is_goal(state):
+                        return limits.finish(
+                            [entry[2] for entry in stack[1:]]
+                        )
+                    limits.expand(len(table), len(stack))
+                    progress = problem.progress(state)
+                    if best_progress is None or progress > best_progress:
+                        best_progress = progress
+                        best_moves = [entry[2] for entry in stack[1:]]
+                    children = []
+                    for next_state, next_move, cost in \
+                     problem.next_states(state):
+                        if next_state in path:
+                            stats.duplicates += 1
+                            continue
+                        next_step_cost = step_cost + cost
+                        next_cost = next_step_cost + \
+                            weight * problem.heuristic(next_state)
+                        if next_cost > threshold:
+                            if next_threshold is None or \
+                             next_cost < next_threshold:
+                                next_threshold = next_cost
+                            continue
+                        children.append(
+                            (next_cost, next_step_cost, next_state, next_move)
+                        )
+                    children.sort(key=lambda child: child[:2])
+                    children = iter(children)
+                    stack[-1] = (state, step_cost, move, children)
+
+                for _, next_step_cost, next_state, next_move in children:
+                    table_step_cost = table.get(next_state)
+                    if table_step_cost is not None and \
+                     table_step_cost <= next_step_cost:
+                        stats.duplicates += 1
+                        continue
+                    if len(table) >= table_size:
+                        table.clear()
+                    table[next_state] = next_step_cost
+                    path.add(next_state)
+                    stack.append((next_state, next_step_cost, next_move, None))
+                    break
+                else:
+                    path.discard(state)
+                    stack.pop()
+
+            if next_threshold is None:
+                return limits.finish(None)
+            threshold = next_threshold
+    except SearchLimitExceeded as exc:
+        exc.partial = best_moves
+        limits.finish(None)
+        raise
+
+
+def beam(problem, width=1000, weight=1, stats=None, **budget):
+    """Return a sequence of moves that goes towards the solution using beam
+    search, or None if the beam runs out of states.
+
+    The search goes a level at a time and keeps only the width cheapest
+    states (by step cost plus weight times the heuristic) of each level.
+    Memory is bounded by width times the depth of the search. The solution
+    may not be the cheapest, and a solution may be missed. Each level is
+    scored at once with Problem.heuristic_batch.
+
+    budget and stats are as for astar. The states kept so far count as
+    closed and the current level counts as the fringe.
+    """
+    problem, limits = _instrument(problem, stats, budget)
+    stats = limits.stats
+    nodes = _NodeStore()
+    init_state = problem.initial_state()
+    if problem.is_goal(init_state):
+        return limits.finish([])
+    seen = set([init_state])
+    level = [(init_state, nodes.add())]
+    best_progress = None
+    best_node = None
+    try:
+        while level:
+            # Maps each state of the next level to its (step cost, parent
+            # node, move, state). The state is kept in the value since an
+            # assignment doesn't replace the key, and the state that's
+            # expanded must be the one made by the recorded move (it
+            # remembers the card that move moved).
+            children = {}
+            for state, node in level:
+                limits.expand(len(seen), len(level))
+                progress = problem.progress(state)
+                if best_progress is None or progress > best_progress:
+                    best_progress = progress
+                    best_node = node
+                step_cost = nodes.step_cost(node)
+                for next_state, move, cost in problem.iter_next_states(state):
+                    if next_state in seen:
+                        stats.duplicates += 1
+                        continue
+                    next_step_cost = step_cost + cost
+                    child = children.get(next_state)
+                    if child is not None and child[0] <= next_step_cost:
+                        stats.duplicates += 1
+                        continue
+                    if problem.is_goal(next_state):
+                        return limits.finish(nodes.move_seq(
+                            nodes.add(node, move, next_step_cost)
+                        ))
+                    children[next_state] = (
+                        next_step_cost, node, move, next_state
+                    )
+            states = children.keys()
+            scored = (
+                (state, children[state][0] + weight * heuristic)
+                for state, heuristic in izip(
+                    states, problem.heuristic_batch(states)
+                )
+            )
+            best = nsmallest(
+                width, scored,
+                key=lambda item: (item[1], children[item[0]][0])
+            )
+            level = []
+            for state, _ in best:
+                step_cost, parent, move, state = children[state]
+                seen.add(state)
+                level.append((state, nodes.add(parent, move, step_cost)))
+        return limits.finish(None)
+    except SearchLimitExceeded as exc:
+        if best_node is not None:
+            exc.partial = nodes.move_seq(best_node)
+        limits.finish(None)
+        raise
+
+
+def dfs(problem, stats=None, **budget):
+    """Return a sequence of moves that goes towards the solution using
+    depth-first search, or None if no solution exists.
+
+    The successors of a state are tried in the order of
+    Problem.iter_next_states, and each is made only when the search gets to
+    it, so the states after a good first choice are never made. No state
+    is visited twice. The solution is found fast if the order is good, but
+    it's usually far from the cheapest.
+
+    budget and stats are as for astar. The visited states count as closed
+    and the path counts as the fringe.
+    """
+    problem, limits = _instrument(problem, stats, budget)
+    stats = limits.stats
+    init_state = problem.initial_state()
+    if problem.is_goal(init_state):
+        return limits.finish([])
+    seen = set([init_state])
+    # Each entry is (move to the state, iterator of its successors).
+    stack = [(None, problem.iter_next_states(init_state))]
+    best_progress = problem.progress(init_state)
+    best_moves = []
+    try:
+        limits.expand(len(seen), len(stack))
+        while stack:
+            for next_state, move, _ in stack[-1][1]:
+                if next_state in seen:
+                    stats.duplicates += 1
+                    continue
+                seen.add(next_state)
+                if problem.is_goal(next_state):
+                    return limits.finish(
+                        [entry[0] for entry in stack[1:]] + [move]
+                    )
+                stack.append((move, problem.iter_next_states(next_state)))
+                limits.expand(len(seen), len(stack))
+                progress = problem.progress(next_state)
+                if progress > best_progress:
+                    best_progress = progress
+                    best_moves = [entry[0] for entry in stack[1:]]
+                break
+            else:
+                stack.pop()
+        return limits.finish(None)
+    except SearchLimitExceeded as exc:
+        exc.partial = best_moves
+        limits.finish(None)
+        raise
+
+
+# A record in an external_astar file is this header (the lengths of the
+# encoded state and moves, and the step cost) followed by the encoded state
+# and moves.
+_RECORD = struct.Struct('<HII')
+
+
+def _pack_record(key, step_cost=0, path=''):
+    """Return a record of this encoded state, step cost and encoded moves."""
+    return _RECORD.pack(len(key), len(path), step_cost) + key + path
+
+
+def _write_record(file_obj, key, step_cost=0, path=''):
+    """Write a record of this encoded state, step cost and encoded moves."""
+    file_obj.write(_pack_record(key, step_cost, path))
+
+
+def _read_records(filename):
+    """Yield the (encoded state, step cost, encoded moves) records in this
+    file, reading it through mmap.
+    """
+    size = os.path.getsize(filename)
+    if size == 0:
+        return
+    with open(filename, 'rb') as file_obj:
+        data = mmap.mmap(file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        offset = 0
+        while offset < size:
+            key_length, path_length, step_cost = \
+                _RECORD.unpack_from(data, offset)
+            offset += _RECORD.size
+            key = data[offset:offset+key_length]
+            offset += key_length
+            path = data[offset:offset+path_length]
+            offset += path_length
+            yield key, step_cost, path
+    finally:
+        data.close()
+
+
+class _SpillFiles(object):
+    """The files of an external_astar search, in a directory.
+
+    The fringe is a bucket file of records for each cost and step cost,
+    appended to in the order they're generated. Records are held in memory
+    until they add up to _MAX_UNWRITTEN bytes, and then appended to their
+    buckets' files, so the files are only open while they're written. As
+    in _PriorityQueue, the cheapest bucket comes out first, and ties go to
+    the deeper one. The closed set is a list of files (runs) of the encoded
+    states in sorted order. Duplicates are only found when a bucket is
+    about to be expanded: it's sorted in batches of batch_size records, and
+    the sorted runs are merged with each other and with the closed runs.
+    Only a batch is ever in memory, the files are read and written in
+    order, and no more than about 2 * _MAX_MERGE_RUNS files are open.
     """
-    return _search(problem, _PriorityQueue)
-            
+
+    # The most runs that are merged at once, each of which has its file
+    # open. The runs of the closed set are merged into one when there are
+    # more than this many.
+    _MAX_MERGE_RUNS = 16
+
+    _MAX_UNWRITTEN = 1 << 20
+
+    def __init__(self, directory, batch_size, stats):
+        self._directory = directory
+        self._batch_size = batch_size
+        self._stats = stats
+        self._names = count()
+        # Maps (cost, -step cost) to the [file name, number of records,
+        # packed records not written to the file yet] of its bucket
+        self._buckets = {}
+        # The bytes of the records in memory
+        self._unwritten = 0
+        self._closed_runs = []
+        self.num_open = 0
+        self.num_closed = 0
+
+    def _new_name(self):
+        """Return the name for a new file."""
+        return os.path.join(self._directory, str(next(self._names)))
+
+    def _new_file(self):
+        """Return a new file open for writing."""
+        return open(self._new_name(), 'wb')
+
+    def push(self, cost, key, step_cost, path):
+        """Add a record to the bucket for this cost and step cost."""
+        bucket_key = (cost, -step_cost)
+        bucket = self._buckets.get(bucket_key)
+        if bucket is None:
+            bucket = self._buckets[bucket_key] = [self._new_name(), 0, []]
+        bucket[1] += 1
+        record = _pack_record(key, step_cost, path)
+        bucket[2].append(record)
+        self.num_open += 1
+        self._unwritten += len(record)
+        if self._unwritten >= self._MAX_UNWRITTEN:
+            for bucket in self._buckets.itervalues():
+                self._write_bucket(bucket)
+
+    def _write_bucket(self, bucket):
+        """Append the records of this bucket that are in memory to its
+        file.
+        """
+        filename, _, records = bucket
+        if records:
+            data = ''.join(records)
+            with open(filename, 'ab') as file_obj:
+                file_obj.write(data)
+            self._unwritten -= len(data)
+            del records[:]
+
+    def pop(self):
+        """Remove the cheapest bucket and return an iterator of its records
+        that aren't duplicates of each other or closed, sorted by encoded
+        state, or None if there are no buckets. Each record's state is
+        closed as it's returned. The records generated while it's expanded
+        go into new buckets.
+        """
+        if not self._buckets:
+            return None
+        bucket = self._buckets.pop(min(self._buckets))
+        self._write_bucket(bucket)
+        self.num_open -= bucket[1]
+        return self._unique(self._sort(bucket[0]))
+
+    def _sort(self, filename):
+        """Return the names of at most _MAX_MERGE_RUNS runs of this file's
+        records sorted in batches, and remove the file.
+        """
+        runs = []
+        batch = []
+        for record in _read_records(filename):
+            batch.append(record)
+            if len(batch) == self._batch_size:
+                runs.append(self._write_run(batch))
+                batch = []
+        os.remove(filename)
+        if batch:
+            runs.append(self._write_run(batch))
+        while len(runs) > self._MAX_MERGE_RUNS:
+            runs = [
+                self._merge_runs(runs[start:start+self._MAX_MERGE_RUNS])
+                for start in xrange(0, len(runs), self._MAX_MERGE_RUNS)
+            ]
+        return runs
+
+    def _write_run(self, records):
+        """Write these records to a new file in sorted order and return its
+        name.
+        """
+        records.sort()
+        with self._new_file() as file_obj:
+            for record in records:
+                _write_record(file_obj, *record)
+        return file_obj.name
+
+    def _merge_runs(self, runs):
+        """Merge these runs into a new one, remove them and return its
+        name.
+        """
+        if len(runs) == 1:
+            return runs[0]
+        with self._new_file() as file_obj:
+            for record in merge(*[_read_records(run) for run in runs]):
+                _write_record(file_obj, *record)
+        for run in runs:
+            os.remove(run)
+        return file_obj.name
+
+    def _unique(self, runs):
+        """Yield the records merged from these runs, leaving out all but
+        the cheapest for each state and the ones for closed states, and
+        close their states in a new run. Remove the runs when done.
+        """
+        closed = merge(*[_read_records(run) for run in self._closed_runs])
+        closed_key = next(closed, (None,))[0]
+        last_key = None
+        with self._new_file() as closing:
+            for record in merge(*[_read_records(run) for run in runs]):
+                key = record[0]
+                while closed_key is not None and closed_key < key:
+                    closed_key = next(closed, (None,))[0]
+                if key == last_key or key == closed_key:
+                    self._stats.duplicates += 1
+                    continue
+                last_key = key
+                _write_record(closing, key)
+                self.num_closed += 1
+                yield record
+        for run in runs:
+            os.remove(run)
+        self._closed_runs.append(closing.name)
+        if len(self._closed_runs) > self._MAX_MERGE_RUNS:
+            self._closed_runs = [self._merge_runs(self._closed_runs)]
+
+    def remove(self):
+        """Remove the directory."""
+        shutil.rmtree(self._directory)
+
+
+# The most successors external_astar scores at once
+_HEURISTIC_BATCH_SIZE = 1000
+
+
+def external_astar(
+    problem, weight=1, directory=None, batch_size=100000, stats=None,
+    **budget
+):
+    """Return a sequence of moves that goes towards the solution, searching
+    with A* (weighted A* with a weight above 1) that keeps its fringe and
+    closed set in files instead of memory. If no solution exists, return
+    None.
+
+    The fringe is a file per cost and step cost. The cheapest (and then
+    deepest) is expanded all at once, after finding its duplicates by
+    sorting it in batches of batch_size records and merging them with the
+    sorted files of the closed set (see _SpillFiles). Memory is bounded by
+    batch_size, so the search can be much larger than memory. The files
+    are in a new directory in directory (the system's temporary directory
+    by default), which is removed at the end. Successors are scored with
+    Problem.heuristic_batch in batches of up to _HEURISTIC_BATCH_SIZE.
+
+    Each record holds the encoded state and the encoded moves to it, so the
+    problem must implement Problem.encode_state, decode_state, encode_moves
+    and decode_moves, and costs must be integers. The solution costs as
+    much as one from astar with the same weight.
+
+    budget and stats are as for astar. The states in the fringe files count
+    as the fringe.
+    """
+    problem, limits = _instrument(problem, stats, budget)
+    stats = limits.stats
+    spill = _SpillFiles(
+        tempfile.mkdtemp(prefix='external_astar', dir=directory),
+        batch_size, stats
+    )
+    init_state = problem.initial_state()
+    spill.push(
+        weight * problem.heuristic(init_state),
+        problem.encode_state(init_state), 0, ''
+    )
+    # The (state, step cost, path) of successors waiting to be scored with
+    # Problem.heuristic_batch and pushed
+    children = []
+
+    def push_children():
+        heuristics = problem.heuristic_batch([child[0] for child in children])
+        for (state, step_cost, path), heuristic in izip(children, heuristics):
+            spill.push(
+                step_cost + weight * heuristic, problem.encode_state(state),
+                step_cost, path
+            )
+        del children[:]
+
+    best_progress = None
+    best_path = None
+    try:
+        while True:
+            push_children()
+            records = spill.pop()
+            if records is None:
+                return limits.finish(None)
+            for key, step_cost, path in records:
+                state = problem.decode_state(key)
+                limits.expand(spill.num_closed, spill.num_open)
+                if problem.is_goal(state):
+                    return limits.finish(problem.decode_moves(path))
+                progress = problem.progress(state)
+                if best_progress is None or progress > best_progress:
+                    best_progress = progress
+                    best_path = path
+                for next_state, move, cost in problem.next_states(state):
+                    children.append((
+                        next_state, step_cost + cost,
+                        path + problem.encode_moves([move])
+                    ))
+                if len(children) >= _HEURISTIC_BATCH_SIZE:
+                    push_children()
+    except SearchLimitExceeded as exc:
+        if best_path is not None:
+            exc.partial = problem.decode_moves(best_path)
+        limits.finish(None)
+        raise
+    finally:
+        spill.remove()
+
+
+def _hda_worker(
+    problem, index, inboxes, results, weight, round_size, instrument
+):
+    """Run a worker process for hdastar.
+
+    The worker owns the states whose hash modulo the number of workers is
+    index. It keeps their closed set, fringe and nodes. A node is known to
+    other workers by its global id, node * number of workers + index.
+
+    Messages in its inbox are:
+    ('nodes', [(state, step cost, cost, parent global id, move), ...]),
+    ('round', number of 'nodes' messages sent to it so far, cost limit,
+    cost bound), ('trace', node), and ('stop',). In a round, the worker
+    expands nodes that cost no more than the limit (the lowest cost of all
+    the workers' nodes) and less than the bound (the cost of the best goal).
+    It reports its SearchStats after each round, with the successors and
+    heuristic counted and timed if instrument.
+    """
+    # Interrupts are for the coordinator, which cancels the search.
+    signal(SIGINT, SIG_IGN)
+    stats = SearchStats()
+    if instrument:
+        problem = _InstrumentedProblem(problem, stats)
+    num_workers = len(inboxes)
+    inbox = inboxes[index]
+    # Maps an expanded state to its step cost. Workers don't expand in the
+    # global order, so a state is reopened if a cheaper path to it arrives.
+    closed = {}
+    nodes = _NodeStore()
+    fringe = _PriorityQueue()
+    received = 0
+    # The (progress, global id) of the expanded node with the most progress
+    best = None
+
+    def is_new(state, step_cost):
+        """Return whether this is the cheapest path to this state so far."""
+        closed_step_cost = closed.get(state)
+        if (closed_step_cost is None or step_cost < closed_step_cost) \
+         and fringe.accepts(state, step_cost):
+            return True
+        stats.duplicates += 1
+        return False
+
+    def receive(msg):
+        for state, step_cost, cost, parent, move in msg[1]:
+            if is_new(state, step_cost):
+                fringe.push(
+                    state, nodes.add(parent, move, step_cost), step_cost, cost
+                )
+
+    try:
+        while True:
+            msg = inbox.get()
+            if msg[0] == 'nodes':
+                receive(msg)
+                received += 1
+                continue
+            if msg[0] == 'trace':
+                node = msg[1]
+                results.put(('trace', nodes.parent(node), nodes.move(node)))
+                continue
+            if msg[0] == 'stop':
+                for other_inbox in inboxes:
+                    other_inbox.cancel_join_thread()
+                return
+
+            expected, limit, bound = msg[1:]
+            while received < expected:
+                receive(inbox.get())
+                received += 1
+
+            outgoing = [[] for _ in xrange(num_workers)]
+            goal = None
+            expanded = 0
+            while expanded < round_size and not fringe.is_empty():
+                min_cost = fringe.min_cost()
+                if min_cost > limit or min_cost >= bound:
+                    break
+                state, node = fringe.pop()
+                step_cost = nodes.step_cost(node)
+                if closed.get(state, step_cost + 1) <= step_cost:
+                    continue
+                expanded += 1
+                global_node = node * num_workers + index
+                if problem.is_goal(state):
+                    if step_cost < bound:
+                        bound = step_cost
+                        goal = (step_cost, global_node)
+                    continue
+
+                closed[state] = step_cost
+                progress = problem.progress(state)
+                if best is None or progress > best[0]:
+                    best = (progress, global_node)
+                for next_state, move, cost in problem.next_states(state):
+                    next_step_cost = step_cost + cost
+                    next_cost = next_step_cost + \
+                        weight * problem.heuristic(next_state)
+                    if next_cost >= bound:
+                        continue
+                    owner = hash(next_state) % num_workers
+                    if owner != index:
+                        outgoing[owner].append((
+                            next_state, next_step_cost, next_cost,
+                            global_node, move
+                        ))
+                    elif is_new(next_state, next_step_cost):
+                        fringe.push(
+                            next_state,
+                            nodes.add(global_node, move, next_step_cost),
+                            next_step_cost,
+                            next_cost
+                        )
+
+            sent = [0] * num_workers
+            min_sent_cost = None
+            for owner, batch in enumerate(outgoing):
+                if batch:
+                    inboxes[owner].put(('nodes', batch))
+                    sent[owner] = 1
+                    batch_cost = min(entry[2] for entry in batch)
+                    if min_sent_cost is None or batch_cost < min_sent_cost:
+                        min_sent_cost = batch_cost
+            stats.expanded += expanded
+            stats.closed_size = len(closed)
+            stats.fringe_size = len(fringe)
+            rss = _rss_megabytes()
+            if rss is not None and \
+             (stats.peak_memory is None or rss > stats.peak_memory):
+                stats.peak_memory = rss
+            results.put((
+                'done', index, sent, fringe.min_cost(), min_sent_cost, goal,
+                best, stats.to_dict()
+            ))
+    except Exception:
+        results.put(('error', index, format_exc()))
+
+
+def _hda_result(results):
+    """Return the next message from the hdastar workers. Raise an Exception
+    if a worker failed.
+    """
+    msg = results.get()
+    if msg[0] == 'error':
+        raise Exception('hdastar worker %s failed:\n%s' % msg[1:])
+    return msg
+
+
+def hdastar(
+    problem, workers=None, weight=1, round_size=1000, stats=None, **budget
+):
+    """Return a sequence of moves that goes towards the solution, searching
+    with hash-distributed A* in this many worker processes (the number of
+    CPUs by default). If no solution exists, return None.
+
+    Each worker owns the states whose hash maps to it and sends the states
+    it generates to their owners in batches. The workers run in rounds of
+    up to round_size expansions each. The search stops once the best goal
+    found costs no more than every node left, so the result is as good as
+    the one from astar with the same weight. The states, moves and problem
+    must be picklable and hash the same in every process.
+
+    budget and stats are as for astar. The budget is checked and the stats
+    are gathered between rounds, over all the workers.
+    """
+    if workers is None:
+        workers = cpu_count()
+    inboxes = [Queue() for _ in xrange(workers)]
+    results = Queue()
+    processes = [
+        Process(
+            target=_hda_worker,
+            args=(
+                problem, index, inboxes, results, weight, round_size,
+                stats is not None
+            )
+        )
+        for index in xrange(workers)
+    ]
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    def trace(node):
+        """Return the moves to this global node id."""
+        rtn = []
+        while True:
+            inboxes[node % workers].put(('trace', node // workers))
+            _, parent, move = _hda_result(results)
+            if parent == -1:
+                return list(reversed(rtn))
+            rtn.append(move)
+            node = parent
+
+    try:
+        init_state = problem.initial_state()
+        owner = hash(init_state) % workers
+        inboxes[owner].put(('nodes', [(
+            init_state, 0, weight * problem.heuristic(init_state), -1, None
+        )]))
+        expected = [0] * workers
+        expected[owner] = 1
+        best = None # The (cost, global id) of the best goal
+        lowest = weight * problem.heuristic(init_state)
+        limits = _Limits(stats=stats, **budget)
+        stats = limits.stats
+        # The (progress, global id) of the expanded node with the most
+        # progress, and the latest stats dict from each worker
+        best_progress = None
+        worker_stats = [None] * workers
+
+        while True:
+            bound = float('inf') if best is None else best[0]
+            for index, inbox in enumerate(inboxes):
+                inbox.put(('round', expected[index], lowest, bound))
+
+            lowest = None
+            for _ in xrange(workers):
+                _, index, sent, min_cost, min_sent_cost, goal, progress, \
+                    worker_stats[index] = _hda_result(results)
+                for owner, num_sent in enumerate(sent):
+                    expected[owner] += num_sent
+                for cost in min_cost, min_sent_cost:
+                    if cost is not None and (lowest is None or cost < lowest):
+                        lowest = cost
+                if goal is not None and (best is None or goal < best):
+                    best = goal
+                if progress is not None and \
+                 (best_progress is None or progress[0] > best_progress[0]):
+                    best_progress = progress
+
+            # The coordinator's own memory is added by the report.
+            stats.combine(worker_stats)
+            memory = stats.peak_memory or 0
+            limits.tick(memory)
+            if lowest is None or (best is not None and best[0] <= lowest):
+                break
+            try:
+                limits.check(
+                    stats.expanded, stats.closed_size, True, memory
+                )
+            except SearchLimitExceeded as exc:
+                if best_progress is not None:
+                    exc.partial = trace(best_progress[1])
+                limits.finish(None, memory)
+                raise
+
+        if best is None:
+            return limits.finish(None, memory)
+        return limits.finish(trace(best[1]), memory)
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop',))
+        for process in processes:
+            process.join(1)
+            if process.is_alive():
+                process.terminate()